@@ -1,23 +1,74 @@
 """
 Helper functions for reducing the number of levels in the demographic
 columms. These groupings *are* arbitrary.
+
+`recategorize()` maps each unique value through these functions once
+and returns `pd.Categorical` columns.
 """
 import re
 
+import numpy as np
+import pandas as pd
+
+
+def _recode(values, fn):
+    """Apply `fn` once per unique value in `values` and broadcast
+    the results back to every row
+
+    Parameters
+    ----------
+    values : array-like
+        A demographic column
+    fn : callable
+        One of the `*_categories` functions below
+
+    Returns
+    -------
+    pd.Categorical
+    """
+    codes, uniques = pd.factorize(values)
+    mapped = [fn(u) for u in uniques]
+    if (codes == -1).any():
+        codes = codes.copy()
+        codes[codes == -1] = len(mapped)
+        mapped.append(fn(np.nan))
+    mapped_codes, categories = pd.factorize(np.array(mapped, dtype=object))
+    return pd.Categorical.from_codes(mapped_codes[codes], categories)
+
+def _join(a, b):
+    """Row-wise `' '.join()` of two columns, computed
+    once per unique pair of values
+
+    Parameters
+    ----------
+    a, b : array-like
+        Demographic columns of the same length
+
+    Returns
+    -------
+    pd.Categorical
+    """
+    a_codes, a_uniques = pd.factorize(np.asarray(a))
+    b_codes, b_uniques = pd.factorize(np.asarray(b))
+    assert (a_codes >= 0).all() and (b_codes >= 0).all(), 'Missing values'
+    n = len(b_uniques)
+    pair_codes, pairs = pd.factorize(a_codes * n + b_codes)
+    joined = [' '.join((a_uniques[p // n], b_uniques[p % n])) for p in pairs]
+    return pd.Categorical.from_codes(pair_codes, joined)
 
 def recategorize(df):
-    df['religion'] = df['religion'].apply(religion_categories)
-    df['job'] = df['job'].apply(job_categories)
-    df['drugs'] = df['drugs'].apply(drug_categories)
-    df['diet'] = df['diet'].apply(diet_categories)
-    df['body_type'] = df['body_type'].apply(body_categories)
-    df['drinks'] = df['drinks'].apply(drink_categories)
-    df['sign'] = df['sign'].apply(sign_categories)
-    df['ethnicity'] = df['ethnicity'].apply(ethnicity_categories)
-    df['pets'] = df['pets'].apply(pets_categories)
-    df['speaks'] = df['speaks'].apply(language_categories)
-    df['sex'] = df['sex'].apply(lambda x: str.upper(x))
-    df['gender_orientation'] = df[['sex','orientation']].apply(lambda x: ' '.join(x), axis=1)
+    df['religion'] = _recode(df['religion'], religion_categories)
+    df['job'] = _recode(df['job'], job_categories)
+    df['drugs'] = _recode(df['drugs'], drug_categories)
+    df['diet'] = _recode(df['diet'], diet_categories)
+    df['body_type'] = _recode(df['body_type'], body_categories)
+    df['drinks'] = _recode(df['drinks'], drink_categories)
+    df['sign'] = _recode(df['sign'], sign_categories)
+    df['ethnicity'] = _recode(df['ethnicity'], ethnicity_categories)
+    df['pets'] = _recode(df['pets'], pets_categories)
+    df['speaks'] = _recode(df['speaks'], language_categories)
+    df['sex'] = _recode(df['sex'], lambda x: str.upper(x))
+    df['gender_orientation'] = _join(df['sex'], df['orientation'])
     return df
 
 def religion_categories(religion):
@@ -1,33 +1,201 @@
+from html import unescape
+from html.entities import html5
+from multiprocessing import Pool, cpu_count
 import re
 
 import numpy as np
 import pandas as pd
 from bs4 import BeautifulSoup
 
+from utils.categorize_demographics import recategorize
 
-def clean_up(input_df, col_names, min_words=5):
+
+# tags that essays commonly contain (stripped without an HTML parser)
+SIMPLE_TAGS = re.compile(r'</?(?:a|b|i|u|em|strong|br|p)\b[^<>]*>', re.I)
+# links (removed), runs of periods (-> '. ') and dashes (-> ' - '); the
+# first characters differ, so a single pass matches applying them in turn
+MARKUP = re.compile(r"(?:\@|https?\://)\S+|([.]{2,})|([-]{2,})")
+WHITESPACE = re.compile(r'\s+')
+# character references, or a bare '&' that does not start one
+ENTITY = re.compile(r'&(?:#[0-9]+|#[xX][0-9a-fA-F]+|([a-zA-Z][a-zA-Z0-9]*));'
+                    r'|&')
+# essay columns, as seen by worker processes (see _clean_columns)
+_essays = {}
+
+def _entities_well_formed(text):
+    '''
+    Input : essay text
+    Returns: whether every '&' starts a well-formed, known character
+             reference (&name;, &#NN; or &#xNN;)
+    '''
+    for match in ENTITY.finditer(text):
+        name = match.group(1)
+        if match.group(0) == '&' or (name and name + ';' not in html5):
+            return False
+    return True
+
+def _strip_html(text):
+    '''
+    Input : essay text (may contain HTML)
+    Returns: text content, as BeautifulSoup(text).getText() would
+    Essays usually only contain simple tags (<br />, <a href=...>, ...)
+    and entities, which are removed and unescaped directly; anything
+    else (comments, other tags, stray '<', a bare or unterminated '&'
+    as in "AT&T" or "&nbsphello") goes through BeautifulSoup, whose
+    handling of those differs from unescape()
+    '''
+    if '<' not in text and '&' not in text:
+        return text
+    stripped = SIMPLE_TAGS.sub('', text)
+    if '<' in stripped or not _entities_well_formed(stripped):
+        return BeautifulSoup(text).getText()
+    return unescape(stripped)
+
+def _replace_markup(match):
+    if match.group(1):
+        return '. '
+    elif match.group(2):
+        return ' - '
+    return ''
+
+def _clean_text(text):
+    '''
+    Input : essay text (may contain HTML)
+    Returns: plain text without links, with runs of periods, dashes
+             and whitespace collapsed
+    '''
+    text = MARKUP.sub(_replace_markup, _strip_html(text))
+    return WHITESPACE.sub(' ', text).strip()
+
+def _clean_column(col):
+    '''
+    Input : essay column (pd.Series)
+    Returns: cleaned column, with missing essays as ''
+    '''
+    return col.replace(np.nan, '' , regex=True).apply(_clean_text)
+
+def _init_worker(essays):
+    global _essays
+    _essays = essays
+
+def _clean_shard(task):
+    '''
+    Input : (column, start, stop) task
+    Returns: list of cleaned essays for those rows of _essays[column]
+    '''
+    c, start, stop = task
+    return [_clean_text(text) for text in _essays[c][start:stop]]
+
+def _clean_columns(input_df, col_names, n_jobs=1):
+    '''
+    Input : data frame, list of columns to clean up and number of worker
+            processes (-1 uses all cores)
+    Returns: dict of cleaned columns (pd.Series), by column name
+    Columns are split into row shards that are cleaned in parallel; only
+    the essay text is handed to the workers (once each, when the pool
+    starts, which is free with fork), not the whole data frame
+    '''
+    if n_jobs == -1:
+        n_jobs = cpu_count()
+    if n_jobs == 1 or input_df.shape[0] == 0:
+        return {c : _clean_column(input_df[c]) for c in col_names}
+    essays = {c : input_df[c].replace(np.nan, '' , regex=True).values
+              for c in col_names}
+    n = input_df.shape[0]
+    shard = max(1, -(-n // (4 * n_jobs)))
+    tasks = [(c, i, i + shard) for c in col_names for i in range(0, n, shard)]
+    with Pool(n_jobs, initializer=_init_worker, initargs=(essays,)) as pool:
+        shards = pool.map(_clean_shard, tasks)
+    cleaned = {c : [] for c in col_names}
+    for (c, _, _), texts in zip(tasks, shards):
+        cleaned[c].extend(texts)
+    return {c : pd.Series(cleaned[c], index=input_df.index)
+            for c in col_names}
+
+def clean_up(input_df, col_names, min_words=5, n_jobs=1):
     '''
     Input : data frame and list of columns to clean up
     Returns: cleaned data frame (overwrites those columns)
     Drops user if any essay has < min_words number of words (default = 5)
+    Cleans with n_jobs worker processes (default = 1, -1 for all cores)
     '''
     assert isinstance(col_names, list), 'Must be type list'
     assert isinstance(input_df, pd.DataFrame), 'Must be pd.DataFrame'
+    cleaned = _clean_columns(input_df, col_names, n_jobs)
     dfs = []
     for c in col_names:
-        df = input_df.copy()
-        df[c] = df[c].replace(np.nan, '' , regex=True) \
-                     .apply(lambda x: BeautifulSoup(x).getText().replace('\n', ' '))\
-                     .apply(lambda x: re.sub(r"(?:\@|https?\://)\S+", "", x))\
-                     .apply(lambda x: re.sub('[.]{2,}', '. ', x))\
-                     .apply(lambda x: re.sub('[-]{2,}', ' - ', x))\
-                     .apply(lambda x: re.sub('\s+', ' ', x).strip())
-        token_count = df[c].str.split().str.len() 
+        col = cleaned[c]
+        token_count = col.str.split().str.len() 
         if min_words > 0:
-            df = df[token_count > min_words] #drop rows where current essay has < min_words
+            keep = token_count > min_words #drop rows where current essay has < min_words
+            df = input_df[keep]
+            col = col[keep]
+        else:
+            df = input_df.copy()
+        df[c] = col
         df.fillna('', inplace=True)
         dfs.append(df)
     if len(col_names) == 1:
         return dfs[0]
     else:
         return tuple(dfs)
+
+def clean_columns(input_df, col_names, min_words=5, n_jobs=1):
+    '''
+    Input : data frame and list of columns to clean up
+    Returns: (cleaned, keep), where cleaned is a data frame of only the
+             cleaned columns (same index as input_df) and keep maps each
+             column to a boolean mask of the rows with > min_words words
+             (all True if min_words = 0)
+    input_df is never copied, so memory grows with the number of columns
+    cleaned rather than with the number of columns times the table size;
+    rows for a particular essay are input_df[keep[c]] and cleaned[c][keep[c]]
+    Cleans with n_jobs worker processes (default = 1, -1 for all cores)
+    '''
+    assert isinstance(col_names, list), 'Must be type list'
+    assert isinstance(input_df, pd.DataFrame), 'Must be pd.DataFrame'
+    columns = _clean_columns(input_df, col_names, n_jobs)
+    cleaned = pd.DataFrame(index=input_df.index)
+    keep = {}
+    for c in col_names:
+        cleaned[c] = columns[c]
+        if min_words > 0:
+            keep[c] = (cleaned[c].str.split().str.len() > min_words).values
+        else:
+            keep[c] = np.ones(cleaned.shape[0], dtype=bool)
+    return cleaned, keep
+
+def read_profiles(path, col_names, chunksize=10000, min_words=5):
+    '''
+    Input : path to the profiles csv and list of columns to clean up
+    Yields: cleaned, recategorized data frames of up to chunksize rows
+            (a tuple of data frames, one per column, if len(col_names) > 1)
+    Only one chunk is held in memory at a time
+    '''
+    assert isinstance(col_names, list), 'Must be type list'
+    # essays stay strings even in chunks where they are all missing
+    dtype = {c : object for c in col_names}
+    for chunk in pd.read_csv(path, chunksize=chunksize, dtype=dtype):
+        dfs = clean_up(chunk, col_names, min_words)
+        if len(col_names) == 1:
+            yield recategorize(dfs)
+        else:
+            yield tuple(recategorize(df) for df in dfs)
+
+def write_profiles(path, out_paths, col_names, chunksize=10000, min_words=5):
+    '''
+    Input : path to the profiles csv, list of output paths (one per
+            column) and list of columns to clean up
+    Returns: None; the cleaned, recategorized rows for each column are
+             written chunk by chunk to the corresponding output path
+    '''
+    assert isinstance(out_paths, list), 'Must be type list'
+    assert len(out_paths) == len(col_names), 'One output path per column'
+    header = True
+    for dfs in read_profiles(path, col_names, chunksize, min_words):
+        if len(col_names) == 1:
+            dfs = (dfs,)
+        for df, out in zip(dfs, out_paths):
+            df.to_csv(out, mode='w' if header else 'a',
+                      header=header, index=False)
+        header = False
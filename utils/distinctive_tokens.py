@@ -45,3 +45,217 @@ def log_odds_ratio(counts, feature_names=None, symmetric_alpha=1, use_variance=T
     log_odds = pd.DataFrame(diff, columns=['log_odds_ratio'])
     log_odds.index = feature_names
     return log_odds
+
+def _log_odds(counts, symmetric_alpha=1):
+    """Log odds of each feature within each class
+
+    Parameters
+    ----------
+    counts : np.ndarray
+        2d frequency counts with
+        dimensions (`n_classes`, `n_features`)
+    symmetric_alpha : int
+        constant
+
+    Returns
+    -------
+    np.ndarray
+        shape (`n_classes`, `n_features`)
+    """
+    counts = np.asarray(counts, dtype=float)
+    F = counts.shape[1]
+    totals = counts.sum(axis=1)[:, np.newaxis]
+    return np.log((counts + symmetric_alpha) /
+                  (totals + F * symmetric_alpha - counts - symmetric_alpha))
+
+def _pairwise_rows(counts, rows, symmetric_alpha=1, use_variance=True):
+    """`log_odds_pairwise()` for particular classes (the first axis)
+
+    Parameters
+    ----------
+    counts : np.ndarray
+        2d frequency counts with
+        dimensions (`n_classes`, `n_features`)
+    rows : slice or np.ndarray
+        The classes to compare against every class
+    symmetric_alpha : int
+        constant
+    use_variance : bool, default True
+        whether to account for variance
+
+    Returns
+    -------
+    np.ndarray
+        shape (n_rows, `n_classes`, `n_features`)
+    """
+    return _pairwise_diff(*_odds_terms(counts, symmetric_alpha, use_variance),
+                          rows=rows)
+
+def _odds_terms(counts, symmetric_alpha=1, use_variance=True):
+    """Per-class log odds and, if `use_variance`, inverse smoothed
+    counts (None otherwise), each shape (`n_classes`, `n_features`)"""
+    counts = np.asarray(counts, dtype=float)
+    odds = _log_odds(counts, symmetric_alpha)
+    inverse = 1 / (counts + symmetric_alpha) if use_variance else None
+    return odds, inverse
+
+def _pairwise_diff(odds, inverse, rows):
+    """`_pairwise_rows()` from the output of `_odds_terms()`"""
+    diff = odds[rows, np.newaxis, :] - odds[np.newaxis, :, :]
+    if inverse is not None:
+        diff /= np.sqrt(inverse[rows, np.newaxis, :] + inverse[np.newaxis, :, :])
+    return diff
+
+def log_odds_pairwise(counts, symmetric_alpha=1, use_variance=True):
+    """Log odds ratios for every pair of classes at once
+
+    Parameters
+    ----------
+    counts : np.ndarray
+        2d frequency counts with
+        dimensions (`n_classes`, `n_features`),
+        e.g., from `level_sums()` in `utils/splits.py`
+    symmetric_alpha : int
+        constant
+    use_variance : bool, default True
+        whether to account for variance
+
+    Returns
+    -------
+    np.ndarray
+        shape (`n_classes`, `n_classes`, `n_features`), where
+        `[i, j]` compares class `i` to class `j`
+
+    Notes
+    -----
+    `F` is multiplied by `symmetric_alpha` for every class (see the
+    note in `log_odds_ratio()`); with the default `symmetric_alpha`
+    of 1, `[0, 1]` equals `log_odds_ratio()` for the first two rows
+    """
+    assert isinstance(counts, np.ndarray), 'Must be type np.ndarray'
+    return _pairwise_rows(counts, slice(None), symmetric_alpha, use_variance)
+
+def log_odds_one_vs_rest(counts, symmetric_alpha=1, use_variance=True):
+    """Log odds ratios for each class against all other classes combined
+
+    Parameters
+    ----------
+    counts : np.ndarray
+        2d frequency counts with
+        dimensions (`n_classes`, `n_features`)
+    symmetric_alpha : int
+        constant
+    use_variance : bool, default True
+        whether to account for variance
+
+    Returns
+    -------
+    np.ndarray
+        shape (`n_classes`, `n_features`)
+    """
+    assert isinstance(counts, np.ndarray), 'Must be type np.ndarray'
+    counts = counts.astype(float)
+    rest = counts.sum(axis=0) - counts
+    diff = (_log_odds(counts, symmetric_alpha) -
+            _log_odds(rest, symmetric_alpha))
+    if use_variance:
+        diff /= np.sqrt((1 / (counts + symmetric_alpha)) +
+                        (1 / (rest + symmetric_alpha)))
+    return diff
+
+def _top_n(scores, n):
+    """Indices and values of the `n` largest scores in each row
+
+    Parameters
+    ----------
+    scores : np.ndarray
+        shape (n_rows, `n_features`)
+    n : int
+
+    Returns
+    -------
+    idx, values : (np.ndarray, np.ndarray)
+        shape (n_rows, n), in descending order of value
+    """
+    n = min(n, scores.shape[1])
+    rows = np.arange(scores.shape[0])[:, np.newaxis]
+    idx = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+    idx = idx[rows, np.argsort(-scores[rows, idx], axis=1)]
+    return idx, scores[rows, idx]
+
+def top_log_odds(counts, n, one_vs_rest=False,
+                 symmetric_alpha=1, use_variance=True):
+    """The `n` most distinctive features for every comparison,
+    without materializing the full pairwise tensor
+
+    Parameters
+    ----------
+    counts : np.ndarray
+        2d frequency counts with
+        dimensions (`n_classes`, `n_features`)
+    n : int
+        Number of features to keep per comparison
+    one_vs_rest : bool, default False
+        Whether to compare each class to all others combined
+        rather than to every other class
+    symmetric_alpha : int
+        constant
+    use_variance : bool, default True
+        whether to account for variance
+
+    Returns
+    -------
+    idx, values : (np.ndarray, np.ndarray)
+        Feature indices and log odds ratios, in descending order,
+        of shape (`n_classes`, n) or (`n_classes`, `n_classes`, n)
+
+    Notes
+    -----
+    The features most distinctive of class `j` relative to class `i`
+    (i.e., the bottom of `[i, j]`) are the top of `[j, i]`
+    """
+    assert isinstance(counts, np.ndarray), 'Must be type np.ndarray'
+    if one_vs_rest:
+        return _top_n(log_odds_one_vs_rest(counts, symmetric_alpha,
+                                           use_variance), n)
+    K = counts.shape[0]
+    n = min(n, counts.shape[1])
+    # the per-class terms are computed once, not once per row
+    odds, inverse = _odds_terms(counts, symmetric_alpha, use_variance)
+    idx = np.empty((K, K, n), dtype=np.intp)
+    values = np.empty((K, K, n))
+    for i in range(K):
+        row = _pairwise_diff(odds, inverse, [i])[0]
+        idx[i], values[i] = _top_n(row, n)
+    return idx, values
+
+def top_bottom(values, feature_names, n):
+    """The `n` features with the largest and the `n` with the smallest
+    values, selected with `np.argpartition` (linear in the number of
+    features) rather than a full sort
+
+    Parameters
+    ----------
+    values : np.ndarray
+        1d, with length `n_features` (e.g., log odds ratios)
+    feature_names : list
+        the token names with length `n_features`
+    n : int
+        Number of features to select from each end
+
+    Returns
+    -------
+    top, bottom : (list, list)
+        Tokens, from the largest value down and
+        from the smallest value up, respectively
+    top_idx, bottom_idx : (np.ndarray, np.ndarray)
+        The corresponding column indices
+    """
+    values = np.asarray(values, dtype=float)
+    assert values.ndim == 1 and values.shape[0] == len(feature_names)
+    top_idx, _ = _top_n(values[np.newaxis, :], n)
+    bottom_idx, _ = _top_n(-values[np.newaxis, :], n)
+    top_idx, bottom_idx = top_idx[0], bottom_idx[0]
+    top = [feature_names[i] for i in top_idx]
+    bottom = [feature_names[i] for i in bottom_idx]
+    return top, bottom, top_idx, bottom_idx
@@ -1,16 +1,22 @@
-from collections import defaultdict
+from array import array
 import re
 from string import punctuation
 
 import nltk
+import numpy as np
 import pandas as pd
 from spacy.en import English
 
-from utils.permutation import print_pvalues
+from utils.distinctive_tokens import top_bottom
+from utils.permutation import print_pvalues, pvalue_table
 from utils.text_representation import _levels, _multinomial
 
 
 nlp = English(tagger=True, entity=False)
+# Source: https://spacy.io/docs#token-postags
+POS_TAGS = ('ADJ', 'ADP', 'ADV', 'AUX', 'CONJ', 'DET', 'INTJ', 'NOUN', 'NUM',
+            'PART', 'PRON', 'PROPN', 'PUNCT', 'SCONJ', 'SYM', 'VERB', 'X',
+            'EOL', 'SPACE')
 
 def tagger(doc):
     """For tagging a document
@@ -31,23 +37,200 @@ def tagger(doc):
         for token in sent:
             yield (str(token), str(token.pos_))
 
-def tag_corpus(corpus):
-    """For tagging corpus document tokens
+def _intern(s, table, ids):
+    """Id of `s` in a string table, adding it if it's new
+
+    Parameters
+    ----------
+    s : str
+        The string to look up
+    table : list
+        Strings, by id
+    ids : dict
+        Ids, by string
+
+    Returns
+    -------
+    int
+    """
+    i = ids.get(s)
+    if i is None:
+        i = ids[s] = len(table)
+        table.append(s)
+    return i
+
+
+class TaggedCorpus(object):
+    """Token and part-of-speech ids for a corpus tagged in a single pass
+
+    The tokens for all documents are stored contiguously, with
+    document `i` spanning `offsets[i]:offsets[i + 1]`. Token and
+    part-of-speech ids index into the shared `strings` and `tags`
+    tables, respectively. Iterating over a `TaggedCorpus` yields
+    (token, tag) tuples, like the list `tag_corpus()` used to return.
+
+    Parameters
+    ----------
+    token_ids : array-like
+        Token ids for every token in the corpus
+    pos_ids : array-like
+        Part-of-speech ids for every token in the corpus
+    offsets : array-like
+        Document boundaries, of length n_documents + 1
+    strings : list
+        Token strings, by id
+    tags : list
+        Part-of-speech tags, by id
+    """
+
+    def __init__(self, token_ids, pos_ids, offsets, strings, tags):
+        self.token_ids = np.asarray(token_ids, dtype=np.int32)
+        self.pos_ids = np.asarray(pos_ids, dtype=np.int16)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.strings = strings
+        self.tags = tags
+        self._pos_index = None
+
+    @property
+    def n_docs(self):
+        return self.offsets.shape[0] - 1
+
+    def __len__(self):
+        return self.token_ids.shape[0]
+
+    def __iter__(self):
+        """Yield (token, tag) tuples, as `tagger()` does"""
+        strings, tags = self.strings, self.tags
+        for t, p in zip(self.token_ids, self.pos_ids):
+            yield (strings[t], tags[p])
+
+    def document(self, i):
+        """Token and part-of-speech ids for the `i`th document
+
+        Returns
+        -------
+        token_ids, pos_ids : (np.ndarray, np.ndarray)
+        """
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.token_ids[start:end], self.pos_ids[start:end]
+
+    def subset(self, docs):
+        """A `TaggedCorpus` of particular documents
+
+        Parameters
+        ----------
+        docs : array-like
+            Boolean mask or integer positions of documents
+            (e.g., `df[col].values == level` for the DataFrame
+            the corpus was tagged from)
+
+        Returns
+        -------
+        TaggedCorpus
+            Sharing the string and tag tables of this corpus
+        """
+        docs = np.arange(self.n_docs)[np.asarray(docs)]
+        starts = self.offsets[docs]
+        lengths = self.offsets[docs + 1] - starts
+        offsets = np.append(0, np.cumsum(lengths))
+        positions = (np.arange(offsets[-1]) -
+                     np.repeat(offsets[:-1] - starts, lengths))
+        return TaggedCorpus(self.token_ids[positions], self.pos_ids[positions],
+                            offsets, self.strings, self.tags)
+
+    def positions(self, pos):
+        """Positions of the tokens tagged `pos`
+
+        Parameters
+        ----------
+        pos : str
+            A part-of-speech tag
+
+        Returns
+        -------
+        np.ndarray
+            Indices into `token_ids` (empty if `pos` is never used)
+
+        Notes
+        -----
+        The index from tags to positions is built (with a
+        single sort) the first time this is called
+        """
+        if self._pos_index is None:
+            order = np.argsort(self.pos_ids, kind='mergesort')
+            bounds = np.searchsorted(self.pos_ids[order],
+                                     np.arange(len(self.tags) + 1))
+            self._pos_index = (order, bounds)
+        if pos not in self.tags:
+            return np.empty(0, dtype=np.int64)
+        order, bounds = self._pos_index
+        i = self.tags.index(pos)
+        return order[bounds[i]:bounds[i + 1]]
+
+    def token_counts(self, pos):
+        """Frequency of each token tagged `pos`
+
+        Parameters
+        ----------
+        pos : str
+            A part-of-speech tag
+
+        Returns
+        -------
+        pd.Series
+            Counts, indexed by token, for tokens with nonzero counts
+        """
+        token_ids = self.token_ids[self.positions(pos)]
+        counts = np.bincount(token_ids, minlength=len(self.strings))
+        nonzero = np.flatnonzero(counts)
+        return pd.Series(counts[nonzero],
+                         index=[self.strings[t] for t in nonzero])
+
+
+def parse_corpus(corpus, batch_size=1000, n_threads=2):
+    """Tag every document in a corpus in a single, batched pass
 
     Parameters
     ----------
     corpus : array-like
         A collection of documents
+    batch_size : int, default 1000
+        Number of documents to buffer per batch
+    n_threads : int, default 2
+        Number of threads spaCy uses to tag batches
 
     Returns
     -------
-    tagged : list
-        (token, tag) tuples
+    TaggedCorpus
     """
     assert isinstance(corpus, (list, pd.Series))
-    tagged = []
-    for doc in corpus:
-        tagged.extend(tagger(doc))
+    strings, string_ids = [], {}
+    tags, tag_ids = [], {}
+    token_ids, pos_ids, offsets = array('i'), array('h'), array('q', [0])
+    for doc in nlp.pipe(corpus, batch_size=batch_size, n_threads=n_threads):
+        for token in doc:
+            token_ids.append(_intern(str(token), strings, string_ids))
+            pos_ids.append(_intern(str(token.pos_), tags, tag_ids))
+        offsets.append(len(token_ids))
+    return TaggedCorpus(token_ids, pos_ids, offsets, strings, tags)
+
+def tag_corpus(corpus):
+    """For tagging corpus document tokens
+
+    Parameters
+    ----------
+    corpus : array-like or TaggedCorpus
+        A collection of documents or
+        the output of `parse_corpus()`
+
+    Returns
+    -------
+    tagged : TaggedCorpus
+        Which yields (token, tag) tuples when iterated over
+    """
+    if isinstance(corpus, TaggedCorpus):
+        return corpus
+    tagged = parse_corpus(corpus)
     return tagged
 
 def pos_tokens(tagged, pos):
@@ -55,8 +238,8 @@ def pos_tokens(tagged, pos):
 
     Parameters
     ----------
-    tagged : list
-        (token, tag) tuples
+    tagged : TaggedCorpus or list
+        `tag_corpus()` output or (token, tag) tuples
     pos : str
         A valid part-of-speech tag
 
@@ -71,25 +254,31 @@ def pos_tokens(tagged, pos):
         PRON, PROPN, PUNCT, SCONJ, SYM, VERB, X, EOL, SPACE
     Source: https://spacy.io/docs#token-postags
     """
+    if isinstance(tagged, TaggedCorpus):
+        token_ids = tagged.token_ids[tagged.positions(pos)]
+        return np.array(tagged.strings, dtype=object)[token_ids].tolist()
     return [t for t, p in tagged if p == pos]
 
-def _pos_freq(doc):
-    """Part of speech frequencies for individual documents
-    
+def _pos_columns(tags):
+    """Column of each part-of-speech tag in the `pos_df()` count matrix
+
     Parameters
-    -----------
-    doc : str
-        A document with tokens to tag
-        
+    ----------
+    tags : list
+        Part-of-speech tags, by id (i.e., `TaggedCorpus.tags`)
+
     Returns
     -------
-    pos : dict
-        With counts by tag
+    columns : list
+        `POS_TAGS` followed by any other tags in `tags`
+    tag_columns : np.ndarray
+        The column index for each tag id
     """
-    pos = defaultdict(float)
-    for _, p in tagger(doc):
-        pos[p] += 1
-    return pos
+    columns = list(POS_TAGS)
+    column_ids = {p : i for i, p in enumerate(columns)}
+    tag_columns = np.array([_intern(p, columns, column_ids) for p in tags],
+                           dtype=np.int64)
+    return columns, tag_columns
 
 def pos_df(corpus):
     """Create a DataFrame of part of speech
@@ -97,20 +286,26 @@ def pos_df(corpus):
     
     Parameters
     ----------
-    corpus : array-like
-        A collection of documents
+    corpus : array-like or TaggedCorpus
+        A collection of documents or
+        the output of `parse_corpus()`
         
     Returns
     -------
     df : pd.DataFrame
+        With one row per document and (at least) one
+        column for each tag in `POS_TAGS`, so that
+        DataFrames from different corpora line up
     """
-    assert isinstance(corpus, (list, pd.Series))
-    pos_dfs = []
-    for doc in corpus:
-        frequencies = pd.DataFrame(_pos_freq(doc), index=[0])
-        pos_dfs.append(frequencies)
-    df = pd.concat(pos_dfs, ignore_index=True)
-    df.fillna(0.0, inplace=True)
+    if not isinstance(corpus, TaggedCorpus):
+        corpus = parse_corpus(corpus)
+    columns, tag_columns = _pos_columns(corpus.tags)
+    n_docs, n_cols = corpus.n_docs, len(columns)
+    docs = np.repeat(np.arange(n_docs), np.diff(corpus.offsets))
+    cells = docs * n_cols + tag_columns[corpus.pos_ids]
+    counts = np.bincount(cells, minlength=n_docs * n_cols)
+    counts = counts.reshape(n_docs, n_cols).astype(float)
+    df = pd.DataFrame(counts, columns=columns)
     return df
 
 def pos_normalize(df):
@@ -206,6 +401,69 @@ def pos_by_split(df_orig, df_pos, demographic, pos=None,
         print_pvalues(a, b)
         print()
 
+def split_significance(df_orig, df_features, demographic, columns=None,
+                       d_levels=None, print_levels=False,
+                       permutations=10000, n_jobs=1, alpha=None):
+    """Means and p-values for many feature columns (e.g., part-of-speech
+    proportions, profanity, slang, `n_tokens`) across a two-level
+    demographic split, tested together with `pvalue_table()`
+
+    Parameters
+    ----------
+    df_orig : pd.DataFrame
+        The DataFrame from which `df_features` was created
+    df_features : pd.DataFrame
+        The feature DataFrame, e.g., from `pos_df()`
+    demographic : str
+        A valid demographic-data column in `df_orig`
+    columns : list, default None
+        Feature columns to compare; all numeric columns if None
+    d_levels : list, default None
+        The specific demographic levels desired
+    print_levels : bool, default False
+        Whether to print the demographic levels
+    permutations : int, default 10000
+        Number of permutations
+    n_jobs : int, default 1
+        Number of worker processes; -1 uses all cores
+    alpha : float, default None
+        If given, stop permuting a feature once its p-value is
+        clearly above or below `alpha` (see `pvalue_table()`)
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per feature, with the two levels, their means and the
+        permutation-based and classical (Welch's t-test) p-values
+    """
+    assert (isinstance(df_orig, pd.DataFrame) and
+            isinstance(df_features, pd.DataFrame))
+    assert df_orig.shape[0] == df_features.shape[0]
+    assert demographic in df_orig.columns
+    if columns is None:
+        columns = df_features.select_dtypes(include=[np.number]).columns
+    columns = list(columns)
+    assert set(columns).issubset(df_features.columns)
+    levels = _levels(df_orig[demographic], d_levels, print_levels)
+    assert len(levels) == 2, 'The number of levels must be two'
+    values = df_features[columns].values.astype(float)
+    labels = df_orig[demographic].values
+    arrs = []
+    for d in levels:
+        arr = values[labels == d]
+        n = arr.shape[0]
+        if n < 0.1 * values.shape[0]:
+            print("Warning: '" + d +
+                  "' category has less than 10% of observations (" +
+                  str(n) + ")")
+        arrs.append(arr)
+    table = pvalue_table(arrs[0], arrs[1], columns, permutations,
+                         n_jobs=n_jobs, alpha=alpha)
+    table.insert(0, 'level_a', levels[0])
+    table.insert(1, 'level_b', levels[1])
+    table.index.name = 'feature'
+    return table.reset_index()
+
 def load_words(path):
     """To load profane and slang words
 
@@ -222,7 +480,7 @@ def load_words(path):
     with open(path, 'r') as f:
         return list(set([w.rstrip() for w in f.readlines()]))
 
-def _contains_n(words, corpus):
+def _contains_n(words, corpus, cache_dir=None):
     """Count the number of times a document contains particular words
 
     Parameters
@@ -231,16 +489,18 @@ def _contains_n(words, corpus):
         Words to check for
     corpus : array-like
         A collection of documents
+    cache_dir : str, default None
+        Directory of the on-disk token cache (see `token_cache.py`)
 
     Returns
     -------
     np.ndarray
         Number of tokens by document
     """
-    X, _ = _multinomial(corpus, {'vocabulary' : words})
+    X, _ = _multinomial(corpus, {'vocabulary' : words}, cache_dir=cache_dir)
     return X.toarray().sum(axis=1)
 
-def contains(words, corpus):
+def contains(words, corpus, cache_dir=None):
     """Determine whether a document contains particular words
 
     Parameters
@@ -249,6 +509,8 @@ def contains(words, corpus):
         Words to check for
     corpus : array-like
         A collection of documents
+    cache_dir : str, default None
+        Directory of the on-disk token cache (see `token_cache.py`)
 
     Returns
     -------
@@ -257,20 +519,39 @@ def contains(words, corpus):
     """
     assert isinstance(words, list)
     assert isinstance(corpus, (list, pd.Series))
-    n_words = _contains_n(words, corpus)
+    n_words = _contains_n(words, corpus, cache_dir)
     n_words[n_words > 0] = 1
     return n_words
 
+def _pos_counts(tagged, pos):
+    """Frequency of each `pos` token
+
+    Parameters
+    ----------
+    tagged : TaggedCorpus or list
+        `tag_corpus()` output or (token, tag) tuples
+    pos : str
+        A valid part-of-speech tag
+
+    Returns
+    -------
+    pd.Series
+        Counts, indexed by token
+    """
+    if isinstance(tagged, TaggedCorpus):
+        return tagged.token_counts(pos)
+    return pd.Series(nltk.FreqDist(pos_tokens(tagged, pos)), dtype=np.int64)
+
 def _token_counts(a, b, pos):
     """Create a DataFrame of `pos` token frequencies for particular
-    demographic splits. `a` and `b` are lists of token, part-of-speech
-    tuples (output from `tag_corpus()`).
+    demographic splits. `a` and `b` are `tag_corpus()` outputs
+    (or lists of token, part-of-speech tuples).
 
     Parameters
     ----------
-    a : list
+    a : TaggedCorpus or list
         token, pos tuples
-    b : list
+    b : TaggedCorpus or list
         token, pos tuples
     pos : str
         A valid part-of-speech tag
@@ -280,19 +561,17 @@ def _token_counts(a, b, pos):
     df : pd.DataFrame
         With row 0 corresponding to `a` and row 1 to `b`
     """
-    pos_a = nltk.FreqDist(pos_tokens(a, pos))
-    pos_b = nltk.FreqDist(pos_tokens(b, pos))
-    df_a = pd.DataFrame(pos_a, index=[0])
-    df_b = pd.DataFrame(pos_b, index=[0])
-    df = pd.concat([df_a, df_b], ignore_index=True)
-    df.fillna(0, inplace=True)
+    df = pd.concat([_pos_counts(a, pos), _pos_counts(b, pos)], axis=1)
+    df = df.fillna(0).sort_index().T
+    df.index = [0, 1]
     return df
 
 def print_terms(df, n):
     measure = df.columns[0]
-    print(" | ".join(df.sort_values(measure, ascending=False)[:n].index))
+    top, bottom, _, _ = top_bottom(df[measure].values, df.index, n)
+    print(" | ".join(top))
     print()
-    print(" | ".join(df.sort_values(measure)[:n].index))
+    print(" | ".join(bottom))
 
 def top_terms(a, b, pos, fn, n):
     """Print the top `n` tokens (resulting from `fn`) for
@@ -300,9 +579,9 @@ def top_terms(a, b, pos, fn, n):
 
     Parameters
     ----------
-    a : list
+    a : TaggedCorpus or list
         token, pos tuples
-    b : list
+    b : TaggedCorpus or list
         token, pos tuples
     pos : str
         A valid part-of-speech tag
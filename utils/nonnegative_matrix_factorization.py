@@ -1,7 +1,25 @@
+from multiprocessing import Pool, cpu_count
+import time
+
 import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy.sparse.linalg import LinearOperator, svds
 
 from sklearn.decomposition import NMF
 
+from utils.text_representation import FeatureVectorizer
+
+
+# warm-started fits: iterations per round, relative error improvement
+# below which to stop, and overall cap (as NMF's default max_iter)
+WARM_ROUND = 10
+WARM_TOL = 1e-5
+WARM_MAX_ITER = 200
+
+# the matrix being factorized, as seen by worker processes
+_tfidfmatrix = None
+
 
 def _print_words(model, feature_names, n_top_words):
     """For printing the `n_top_words` for each grouping
@@ -28,7 +46,84 @@ def _print_words(model, feature_names, n_top_words):
         print()
     print()
 
-def nmf_inspect(tfidfmatrix, feature_names, k_vals=[3, 5, 7, 9], n_words=10):
+def _fit(tfidfmatrix, k, W=None, H=None):
+    """Fit NMF with `k` components, from `W` and `H` if given
+
+    Returns
+    -------
+    nmf, W, seconds : (sklearn.decomposition.nmf.NMF, np.ndarray, float)
+
+    Notes
+    -----
+    NMF's stopping rule is relative to the first iteration's gradient,
+    so a good starting point makes it run longer, not shorter. Fits from
+    `W` and `H` instead run `WARM_ROUND` iterations at a time until the
+    reconstruction error improves by less than `WARM_TOL` (relative)
+    """
+    start = time.time()
+    if W is None:
+        nmf = NMF(n_components=k, random_state=42)
+        W = nmf.fit_transform(tfidfmatrix)
+        return nmf, W, time.time() - start
+    err = np.inf
+    for _ in range(0, WARM_MAX_ITER, WARM_ROUND):
+        # tol=0 runs every iteration of the round
+        nmf = NMF(n_components=k, init='custom', random_state=42, tol=0,
+                  max_iter=WARM_ROUND)
+        W = nmf.fit_transform(tfidfmatrix, W=W, H=H)
+        H = nmf.components_
+        if nmf.reconstruction_err_ >= (1 - WARM_TOL) * err:
+            break
+        err = nmf.reconstruction_err_
+    return nmf, W, time.time() - start
+
+def _grow(tfidfmatrix, W, H, k):
+    """Extend a factorization to `k` components, keeping the existing
+    components and initializing the new ones by NNDSVD (Boutsidis &
+    Gallopoulos, 2008) of the residual `tfidfmatrix - W * H`
+
+    Returns
+    -------
+    W, H : (np.ndarray, np.ndarray)
+
+    Notes
+    -----
+    The residual is never formed; `svds` only needs its products with
+    vectors, which cost one sparse and two low-rank multiplications
+    """
+    n_new = k - W.shape[1]
+    X = tfidfmatrix
+    R = LinearOperator(X.shape, dtype=np.float64,
+                       matvec=lambda v: X.dot(v) - W.dot(H.dot(v)),
+                       rmatvec=lambda v: X.T.dot(v) - H.T.dot(W.T.dot(v)))
+    v0 = np.random.RandomState(42).uniform(-1, 1, min(X.shape))
+    U, S, V = svds(R, n_new, v0=v0)
+    W_new = np.zeros((W.shape[0], n_new))
+    H_new = np.zeros((n_new, H.shape[1]))
+    for j in range(n_new):
+        # keep whichever sign pattern carries more of the singular pair
+        x, y = U[:, j], V[j]
+        pos = (np.maximum(x, 0), np.maximum(y, 0))
+        neg = (np.maximum(-x, 0), np.maximum(-y, 0))
+        norms = [np.linalg.norm(a) * np.linalg.norm(b) for a, b in (pos, neg)]
+        (x, y), norm = (pos, norms[0]) if norms[0] >= norms[1] else \
+                       (neg, norms[1])
+        if norm > 0:
+            scale = np.sqrt(S[j] * norm)
+            W_new[:, j] = scale * x / np.linalg.norm(x)
+            H_new[j] = scale * y / np.linalg.norm(y)
+    return np.hstack((W, W_new)), np.vstack((H, H_new))
+
+def _init_worker(tfidfmatrix):
+    global _tfidfmatrix
+    _tfidfmatrix = tfidfmatrix
+
+def _fit_k(k):
+    nmf, _, seconds = _fit(_tfidfmatrix, k)
+    return nmf, seconds
+
+def nmf_inspect(tfidfmatrix, feature_names, k_vals=[3, 5, 7, 9], n_words=10,
+                warm_start=False, n_jobs=1):
     """For looping over various values of `k` and printing the
     top `n_words`
 
@@ -47,16 +142,183 @@ def nmf_inspect(tfidfmatrix, feature_names, k_vals=[3, 5, 7, 9], n_words=10):
     n_words : int
         The top n words to print for each grouping
 
+    warm_start : bool, default False
+        Whether to initialize each `k` (in increasing order) from the
+        solution for the previous `k`, plus new components fitted to
+        what it leaves unexplained, rather than from scratch
+
+    n_jobs : int, default 1
+        Number of processes for fitting the `k` values in parallel;
+        -1 uses all cores. Must be 1 when `warm_start` is True, as
+        each fit then starts from the previous one
+
     Returns
     -------
-    None
+    sweep : pd.DataFrame
+        The reconstruction error and wall time (in seconds) for each `k`
+
+    Notes
+    -----
+    Every fit uses `random_state=42`, so results are deterministic
     """
-    for k in k_vals:
-        nmf = NMF(n_components=k, random_state=42).fit(tfidfmatrix)
+    if n_jobs == -1:
+        n_jobs = cpu_count()
+    assert n_jobs >= 1
+    assert not (warm_start and n_jobs != 1), \
+        'Warm-started fits are sequential; use n_jobs=1'
+    if warm_start:
+        k_vals = sorted(k_vals)
+        fits = []
+        W = H = None
+        for k in k_vals:
+            if W is not None:
+                W, H = _grow(tfidfmatrix, W, H, k)
+            nmf, W, seconds = _fit(tfidfmatrix, k, W, H)
+            H = nmf.components_
+            fits.append((nmf, seconds))
+    elif n_jobs == 1 or len(k_vals) == 1:
+        fits = []
+        for k in k_vals:
+            nmf, _, seconds = _fit(tfidfmatrix, k)
+            fits.append((nmf, seconds))
+    else:
+        with Pool(min(n_jobs, len(k_vals)), initializer=_init_worker,
+                  initargs=(tfidfmatrix,)) as pool:
+            fits = pool.map(_fit_k, k_vals)
+    for k, (nmf, _) in zip(k_vals, fits):
         print(k, end='\n')
         _print_words(nmf, feature_names, n_words)
+    sweep = pd.DataFrame({'k' : k_vals,
+                          'reconstruction_err' : [nmf.reconstruction_err_
+                                                  for nmf, _ in fits],
+                          'seconds' : [seconds for _, seconds in fits]},
+                         columns=['k', 'reconstruction_err', 'seconds'])
+    return sweep
+
+def _nnls(X, components, n_iter=50):
+    """Non-negative least squares weights for each row of `X`
+    given fixed `components`, by coordinate descent
+
+    Parameters
+    ----------
+    X : scipy.sparse.csr.csr_matrix or np.ndarray
+        shape (n_samples, n_features)
+    components : np.ndarray
+        shape (k, n_features)
+    n_iter : int, default 50
+        Number of passes over the `k` coordinates
+
+    Returns
+    -------
+    W : np.ndarray
+        shape (n_samples, k), minimizing ||X - W * components||
+        subject to W >= 0
+
+    Notes
+    -----
+    Only the k x k Gram matrix and the n_samples x k projection of
+    `X` are needed, so the cost per pass is O(n_samples * k^2)
+    """
+    G = components.dot(components.T)
+    C = np.asarray(X.dot(components.T))
+    W = np.zeros(C.shape)
+    for _ in range(n_iter):
+        for j in range(G.shape[0]):
+            if G[j, j] > 0:
+                W[:, j] = np.maximum(0, W[:, j] +
+                                     (C[:, j] - W.dot(G[:, j])) / G[j, j])
+    return W
+
+def _row_batches(tfidfmatrix, batch_size):
+    """Yield consecutive blocks of `batch_size` rows"""
+    for start in range(0, tfidfmatrix.shape[0], batch_size):
+        yield tfidfmatrix[start:start + batch_size]
+
+def online_nmf(tfidfmatrix, k, batch_size=1000, n_epochs=1, random_state=42):
+    """Fit NMF components from row mini-batches, updating the
+    components after each batch (Mairal et al., 2010)
+
+    Parameters
+    ----------
+    tfidfmatrix : scipy.sparse.csr.csr_matrix or iterable
+        The users/features matrix, or an iterable of row batches
+        (e.g., from a streaming vectorizer), which is read once
+
+    k : int
+        The number of groupings to create
+
+    batch_size : int, default 1000
+        Number of rows per mini-batch (when given a matrix)
+
+    n_epochs : int, default 1
+        Number of passes over the rows (when given a matrix)
 
-def nmf_labels(tfidfmatrix, k):
+    random_state : int, default 42
+        Seed for initializing the components
+
+    Returns
+    -------
+    components : np.ndarray
+        shape (k, n_features)
+
+    Notes
+    -----
+    Only the components and the k x k and k x n_features sufficient
+    statistics are kept between batches, so memory doesn't depend on
+    the number of users
+    """
+    if sp.issparse(tfidfmatrix) or isinstance(tfidfmatrix, np.ndarray):
+        epochs = [_row_batches(tfidfmatrix, batch_size)
+                  for _ in range(n_epochs)]
+    else:
+        epochs = [tfidfmatrix]
+    rs = np.random.RandomState(random_state)
+    H = A = B = None
+    t = 0
+    for batches in epochs:
+        for X in batches:
+            t += 1
+            if H is None:
+                avg = np.sqrt(X.mean() / k)
+                H = avg * np.abs(rs.randn(k, X.shape[1]))
+                A = np.zeros((k, k))
+                B = np.zeros((k, X.shape[1]))
+            W = _nnls(X, H)
+            # down-weight statistics gathered with the earlier, worse,
+            # components
+            forget = (1 - 1 / t) ** 2
+            A = forget * A + W.T.dot(W)
+            B = forget * B + np.asarray(X.T.dot(W)).T
+            for _ in range(10):
+                for j in range(k):
+                    if A[j, j] > 0:
+                        H[j] = np.maximum(0, H[j] +
+                                          (B[j] - A[j].dot(H)) / A[j, j])
+    return H
+
+def nmf_transform(tfidfmatrix, components, batch_size=10000):
+    """Group weights for users given fitted components, without refitting
+
+    Parameters
+    ----------
+    tfidfmatrix : scipy.sparse.csr.csr_matrix
+        The users/features data, with the same features as `components`
+
+    components : np.ndarray
+        e.g., from `online_nmf()` or `NMF.components_`
+
+    batch_size : int, default 10000
+        Number of users to transform at a time
+
+    Returns
+    -------
+    W : np.ndarray
+        shape (tfidfmatrix.shape[0], k)
+    """
+    return np.vstack([_nnls(X, components)
+                      for X in _row_batches(tfidfmatrix, batch_size)])
+
+def nmf_labels(tfidfmatrix, k, batch_size=None):
     """For getting the labels (group assignment) associated with
     each sample (user, in this case)
 
@@ -68,11 +330,136 @@ def nmf_labels(tfidfmatrix, k):
     k : int
         The number of groupings to create
 
+    batch_size : int, default None
+        If given, NMF is fit online from mini-batches of `batch_size`
+        users (see `online_nmf()`) instead of all at once
+
     Returns
     -------
     labels : np.ndarray
         An array of group assignments of length tfidfmatrix.shape[0] (users)
     """
-    H = NMF(n_components=k, random_state=42).fit_transform(tfidfmatrix)
+    if batch_size:
+        components = online_nmf(tfidfmatrix, k, batch_size)
+        H = nmf_transform(tfidfmatrix, components, batch_size)
+    else:
+        H = NMF(n_components=k, random_state=42).fit_transform(tfidfmatrix)
     labels = np.argmax(H, axis=1)
     return labels
+
+
+class NMFModel(object):
+    """A fitted vectorizer and NMF components, which can be saved and
+    reused to assign new profiles to groups without refitting
+
+    Parameters
+    ----------
+    k : int
+        The number of groupings to create
+    kwargs : dict, default None
+        Keyword arguments for `FeatureVectorizer`
+    cache_dir : str, default None
+        Directory of the on-disk token cache
+
+    Attributes
+    ----------
+    vectorizer : FeatureVectorizer
+        Vocabulary and IDF weights, set by `fit()`
+    components : np.ndarray
+        shape (k, n_features), set by `fit()`
+    """
+
+    def __init__(self, k, kwargs=None, cache_dir=None):
+        self.k = k
+        self.vectorizer = FeatureVectorizer(kwargs, cache_dir)
+        self.components = None
+
+    def fit(self, corpus, pretokenized=False, batch_size=None):
+        """Fit the vocabulary, IDF weights and components on `corpus`
+
+        Parameters
+        ----------
+        corpus : array-like
+            A collection of documents
+        pretokenized : bool, default False
+            Whether `corpus` is the output of `tokenize_corpus()`
+        batch_size : int, default None
+            If given, NMF is fit online (see `online_nmf()`)
+
+        Returns
+        -------
+        self
+        """
+        _, tfidf, _ = self.vectorizer.fit_transform(corpus, pretokenized)
+        if batch_size:
+            self.components = online_nmf(tfidf, self.k, batch_size)
+        else:
+            nmf = NMF(n_components=self.k, random_state=42).fit(tfidf)
+            self.components = nmf.components_
+        return self
+
+    def assign_groups(self, corpus, pretokenized=False, batch_size=1000):
+        """Group assignments for (new) profiles, by projecting their
+        tf-idf vectors onto the stored components
+
+        Parameters
+        ----------
+        corpus : array-like
+            A collection of documents
+        pretokenized : bool, default False
+            Whether `corpus` is the output of `tokenize_corpus()`
+        batch_size : int, default 1000
+            Number of documents vectorized and projected at a time; only
+            one batch of tf-idf vectors is held in memory
+
+        Returns
+        -------
+        labels : np.ndarray
+            The group assignment for each document
+        W : np.ndarray
+            The group weights, shape (n_samples, k)
+        """
+        assert self.components is not None, 'Must call fit() first'
+        W = [nmf_transform(tfidf, self.components)
+             for _, tfidf in self.vectorizer.transform_batches(
+                 corpus, pretokenized, batch_size)]
+        W = np.vstack(W)
+        return np.argmax(W, axis=1), W
+
+    def save(self, path):
+        """Save the components, vocabulary, IDF weights and vectorizer
+        keyword arguments to an `.npz` file
+
+        Parameters
+        ----------
+        path : str
+            Relative or absolute filepath
+
+        Returns
+        -------
+        None
+        """
+        assert self.components is not None, 'Must call fit() first'
+        np.savez(path, components=self.components,
+                 **self.vectorizer._arrays())
+
+    @classmethod
+    def load(cls, path, cache_dir=None):
+        """Load an `NMFModel` saved with `save()`
+
+        Parameters
+        ----------
+        path : str
+            Relative or absolute filepath
+        cache_dir : str, default None
+            Directory of the on-disk token cache
+
+        Returns
+        -------
+        NMFModel
+        """
+        with np.load(path) as data:
+            model = cls(data['components'].shape[0])
+            model.components = data['components']
+            model.vectorizer = FeatureVectorizer._from_arrays(data, cache_dir)
+        return model
@@ -1,27 +1,238 @@
+from multiprocessing import Pool, cpu_count
+import time
+
 import numpy as np
-from scipy.stats import ttest_ind
+import pandas as pd
+import scipy.sparse as sp
+from scipy.stats import beta, hypergeom, norm, ttest_ind
 from sklearn.metrics import accuracy_score
 
 
-def _diff_means(m, arr):
-    """Calculate the difference-in-means statistic.
-    This is based on an input array, `arr`, where the first
-    `m` observations correspond to a particular class.
+# upper bound on the number of elements in a chunk of permutations
+MAX_CHUNK_ELEMENTS = 2 ** 22
+
+# chunk `i` of permutations is drawn from np.random.RandomState([SEED, i])
+SEED = 42
+
+# permutations run between checks of the sequential stopping rule
+SEQUENTIAL_STEP = 100
+
+# the class size, pooled feature matrix and observed statistics,
+# as seen by worker processes
+_features = None
+
+def _subset_chunk(n, k, rows, i):
+    """Positions that land in the first `k` places of `rows` random
+    permutations of `n` samples
+
+    Parameters
+    ----------
+    n : int
+        Number of samples being permuted
+    k : int
+        Size of the subset
+    rows : int
+        Number of permutations
+    i : int
+        Chunk number, which seeds the draw
+
+    Returns
+    -------
+    np.ndarray
+        shape (rows, k)
+
+    Notes
+    -----
+    The whole chunk is drawn at once, by partitioning random keys,
+    instead of shuffling once per permutation. Seeding each chunk
+    separately makes a chunk independent of those before it
+    """
+    rs = np.random.RandomState([SEED, i])
+    keys = rs.randint(0, 2 ** 32, (rows, n), dtype=np.uint32)
+    return np.argpartition(keys, k - 1, axis=1)[:, :k]
+
+def _diff_means_subsets(m, X, idx):
+    """Difference in means of every column of `X` for each permutation
 
     Parameters
     ----------
     m : int
         Number of samples in the first class
-    arr : np.ndarray
-        Data for both classes
+    X : np.ndarray
+        Data for both classes, shape (n_samples, n_columns)
+    idx : np.ndarray
+        From `_subset_chunk()`: the permuted positions of the first
+        class, or of the second class when it is the smaller one
+
+    Returns
+    -------
+    np.ndarray
+        shape (n_permutations, n_columns)
+
+    Notes
+    -----
+    The class sums are a sparse (n_permutations, n_samples)
+    indicator matrix times `X`, so no permuted copy of `X` is made
+    """
+    rows, k = idx.shape
+    indicator = sp.csr_matrix((np.ones(rows * k), idx.ravel(),
+                               np.arange(0, rows * k + 1, k)),
+                              shape=(rows, X.shape[0]))
+    total = X.sum(axis=0)
+    sums = indicator.dot(X)
+    if k != m:
+        sums = total - sums
+    return sums / m - (total - sums) / (X.shape[0] - m)
+
+def _accuracy_batch(y_true, arrs):
+    """Vectorized `accuracy_score()` over the rows of `arrs`
+
+    Parameters
+    ----------
+    y_true : np.ndarray
+        Ground truth (correct) labels
+    arrs : np.ndarray
+        Permuted predicted labels, shape (n_permutations, n_samples)
+
+    Returns
+    -------
+    np.ndarray
+        shape (n_permutations,)
+    """
+    return (arrs == y_true).mean(axis=1)
+
+def _chunk_rows(n, chunk_size=None):
+    """Number of permutations to hold in memory at once
+
+    Parameters
+    ----------
+    n : int
+        Number of samples being permuted
+    chunk_size : int, default None
+        Maximum number of elements in a chunk
+
+    Returns
+    -------
+    int
+    """
+    if not chunk_size:
+        chunk_size = MAX_CHUNK_ELEMENTS
+    return max(1, chunk_size // max(n, 1))
+
+def _permutation_indices(n, permutations, chunk_size=None):
+    """Yield permuted indices in memory-bounded chunks
+
+    Parameters
+    ----------
+    n : int
+        Number of samples being permuted
+    permutations : int
+        Total number of permutations
+    chunk_size : int, default None
+        Maximum number of elements in a chunk
+
+    Yields
+    ------
+    np.ndarray
+        shape (n_rows, n), where each row indexes a permutation
+
+    Notes
+    -----
+    Only used for `comparison='predictions'` Monte Carlo p-values.
+    Successive rows compose the shuffles, as repeatedly calling
+    `np.random.shuffle` on the same array does, so with
+    `np.random.seed(42)` the random draws (and the resulting p-values)
+    match a sequential loop of shuffles. `comparison='means'` draws
+    its permutations per chunk instead (see `_subset_chunk()`)
+    """
+    rows = _chunk_rows(n, chunk_size)
+    idx = np.arange(n)
+    done = 0
+    while done < permutations:
+        size = min(rows, permutations - done)
+        chunk = np.empty((size, n), dtype=idx.dtype)
+        for i in range(size):
+            np.random.shuffle(idx)
+            chunk[i] = idx
+        done += size
+        yield chunk
+
+def _setup(a, b):
+    """The permuted predictions, observed accuracy and vectorized
+    statistic for `_permute(comparison='predictions')`"""
+    c = np.asarray(b)
+    return c, accuracy_score(a, c), _accuracy_batch
+
+def _exact_accuracy(a, b):
+    """Exact permutation p-value of the accuracy of binary predictions
+
+    Parameters
+    ----------
+    a : np.ndarray
+        Ground truth (correct) labels
+    b : np.ndarray
+        Predicted labels; `a` and `b` have at most two distinct
+        labels between them
+
+    Returns
+    -------
+    float
+
+    Notes
+    -----
+    With `n_a` positives in `a` and `n_b` in `b`, the number of
+    true positives under permutation of `b` is hypergeometric, and
+    the number of correct predictions, n - n_a - n_b + 2 * TP, is
+    increasing in it
+    """
+    labels = np.union1d(a, b)
+    assert labels.shape[0] <= 2
+    if labels.shape[0] < 2:
+        return 1.0
+    positive = labels[1]
+    tp = np.sum((a == positive) & (b == positive))
+    return float(hypergeom.sf(tp - 1, a.shape[0], np.sum(b == positive),
+                              np.sum(a == positive)))
+
+def _asymptotic_accuracy(a, b):
+    """Normal approximation to the permutation p-value of the
+    accuracy of predictions with any number of labels
+
+    Parameters
+    ----------
+    a : np.ndarray
+        Ground truth (correct) labels
+    b : np.ndarray
+        Predicted labels
 
     Returns
     -------
     float
+
+    Notes
+    -----
+    The number of correct predictions is a linear permutation
+    statistic, sum_i d(i, pi(i)) with d(i, j) = [a_i == b_j], whose
+    mean and variance are known (Hoeffding's combinatorial central
+    limit theorem); both depend only on the label counts, so this
+    is O(n_labels^2). A continuity correction is applied
     """
-    return np.mean(arr[:m]) - np.mean(arr[m:])
+    n = a.shape[0]
+    labels = np.union1d(a, b)
+    r = np.array([np.sum(a == l) for l in labels], dtype=float)
+    c = np.array([np.sum(b == l) for l in labels], dtype=float)
+    mean = r.dot(c) / n
+    grand = mean / n
+    d = (np.eye(labels.shape[0]) - c[:, np.newaxis] / n -
+         r[np.newaxis, :] / n + grand)
+    variance = (r[:, np.newaxis] * c[np.newaxis, :] * d ** 2).sum() / (n - 1)
+    correct = np.sum(a == b)
+    if variance <= 0:
+        return 1.0 if correct <= mean else 0.0
+    return float(norm.sf((correct - 0.5 - mean) / np.sqrt(variance)))
 
-def _permute(a, b, comparison='predictions', permutations=10000):
+def _permute(a, b, comparison='predictions', permutations=10000,
+             chunk_size=None, method='auto'):
     """Estimate of the permutation-based p-value
 
     Parameters
@@ -36,6 +247,15 @@ def _permute(a, b, comparison='predictions', permutations=10000):
         {'predictions', 'means'}
     permutations : int, optional
         Number of permutations
+    chunk_size : int, default None
+        Maximum number of elements held in memory per chunk
+        of permutations (see `MAX_CHUNK_ELEMENTS`)
+    method : str, default 'auto'
+        {'auto', 'exact', 'asymptotic', 'monte_carlo'}
+        For predictions, 'exact' (binary labels only) and
+        'asymptotic' compute the p-value analytically; 'auto' uses
+        'exact' for binary labels and 'monte_carlo' otherwise.
+        Means are always compared by Monte Carlo
 
     Returns
     -------
@@ -48,22 +268,344 @@ def _permute(a, b, comparison='predictions', permutations=10000):
     This calculates the two-tailed p-value
     """
     assert comparison in ('predictions', 'means')
+    assert method in ('auto', 'exact', 'asymptotic', 'monte_carlo')
+    if comparison == 'predictions' and method != 'monte_carlo':
+        a, b = np.asarray(a), np.asarray(b)
+        binary = np.union1d(a, b).shape[0] <= 2
+        if method == 'exact' or (method == 'auto' and binary):
+            assert binary, "'exact' requires at most two labels"
+            return _exact_accuracy(a, b)
+        if method == 'asymptotic':
+            return _asymptotic_accuracy(a, b)
+    if comparison == 'means':
+        X = np.append(a, b).astype(float)[:, np.newaxis]
+        extreme, _ = _permute_columns(a.shape[0], X, permutations, chunk_size)
+        return extreme[0] / permutations
     np.random.seed(42)
-    if comparison == 'predictions':
-        c = b.copy()
-        compare = accuracy_score
-    else:
-        c = np.append(a, b)
-        a = a.shape[0]
-        compare = _diff_means
-    baseline = compare(a, c)
-    v = []
-    for _ in range(permutations):
-        np.random.shuffle(c)
-        v.append(compare(a, c))
-    p_value = (np.abs(np.array(v)) >= np.abs(baseline)).sum() / permutations
+    c, baseline, compare = _setup(a, b)
+    extreme = 0
+    for idx in _permutation_indices(c.shape[0], permutations, chunk_size):
+        v = compare(a, c[idx])
+        extreme += (np.abs(v) >= np.abs(baseline)).sum()
+    p_value = extreme / permutations
     return p_value
 
+def validate_accuracy_pvalues(n_samples=(50, 500, 5000), n_labels=(2, 3, 5),
+                              signal=(0.0, 0.05, 0.1),
+                              permutations=10000, random_state=0):
+    """Compare the analytic accuracy p-values with Monte Carlo ones
+    on simulated predictions
+
+    Parameters
+    ----------
+    n_samples : iterable, default (50, 500, 5000)
+        Numbers of observations to simulate
+    n_labels : iterable, default (2, 3, 5)
+        Numbers of distinct labels to simulate
+    signal : iterable, default (0.0, 0.05, 0.1)
+        Probabilities that a simulated prediction is copied from the
+        truth (otherwise it's drawn at random)
+    permutations : int, default 10000
+        Number of Monte Carlo permutations
+    random_state : int, default 0
+        Seed for the simulated labels
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per setting, with the Monte Carlo p-value and its
+        standard error, the analytic p-value (exact for binary labels,
+        asymptotic otherwise), their difference in standard errors and
+        the time, in seconds, each took
+    """
+    rs = np.random.RandomState(random_state)
+    rows = []
+    for n in n_samples:
+        for k in n_labels:
+            for p in signal:
+                a = rs.randint(0, k, n)
+                b = np.where(rs.rand(n) < p, a, rs.randint(0, k, n))
+                method = 'exact' if k <= 2 else 'asymptotic'
+                start = time.time()
+                analytic = _permute(a, b, permutations=permutations,
+                                    method=method)
+                analytic_s = time.time() - start
+                start = time.time()
+                monte_carlo = _permute(a, b, permutations=permutations,
+                                       method='monte_carlo')
+                monte_carlo_s = time.time() - start
+                se = np.sqrt(max(analytic * (1 - analytic), 1e-12) /
+                             permutations)
+                rows.append({'n' : n, 'labels' : k, 'signal' : p,
+                             'method' : method, 'analytic' : analytic,
+                             'monte_carlo' : monte_carlo,
+                             'z' : (monte_carlo - analytic) / se,
+                             'analytic_s' : analytic_s,
+                             'monte_carlo_s' : monte_carlo_s})
+    return pd.DataFrame(rows, columns=['n', 'labels', 'signal', 'method',
+                                       'analytic', 'monte_carlo', 'z',
+                                       'analytic_s', 'monte_carlo_s'])
+
+def _confidence_interval(extreme, n, confidence=0.999):
+    """Clopper-Pearson interval on a Monte Carlo p-value
+
+    Parameters
+    ----------
+    extreme : int or np.ndarray
+        Number of permutations at least as extreme as observed
+    n : int or np.ndarray
+        Number of permutations run
+    confidence : float, default 0.999
+        Coverage of the interval
+
+    Returns
+    -------
+    lower, upper : (np.ndarray, np.ndarray)
+    """
+    extreme = np.asarray(extreme, dtype=float)
+    n = np.asarray(n, dtype=float)
+    tail = (1 - confidence) / 2
+    with np.errstate(invalid='ignore'):
+        lower = np.where(extreme > 0,
+                         beta.ppf(tail, extreme, n - extreme + 1), 0.0)
+        upper = np.where(extreme < n,
+                         beta.ppf(1 - tail, extreme + 1, n - extreme), 1.0)
+    return lower, upper
+
+def _decided(lower, upper, alpha):
+    """Whether the interval is entirely on one side of `alpha`"""
+    return (upper < alpha) | (lower > alpha)
+
+def _permute_sequential(a, b, comparison='predictions', alpha=0.05,
+                        permutations=10000, confidence=0.999,
+                        step=SEQUENTIAL_STEP, chunk_size=None):
+    """`_permute()` that stops early, once the confidence interval
+    on the p-value is entirely above or below `alpha`
+
+    Parameters
+    ----------
+    a : np.ndarray
+        Data for one class or
+        ground truth (correct) labels
+    b : np.ndarray
+        Data for another class or
+        predicted labels, as returned by a classifier
+    comparison : str
+        {'predictions', 'means'}
+    alpha : float, default 0.05
+        Significance level the p-value is compared to
+    permutations : int, optional
+        Maximum number of permutations
+    confidence : float, default 0.999
+        Coverage of the interval used to decide when to stop
+    step : int, default `SEQUENTIAL_STEP`
+        Permutations run between checks
+    chunk_size : int, default None
+        Maximum number of elements held in memory per chunk
+
+    Returns
+    -------
+    p_value : float
+        The proportion of times a value as extreme
+        as the observed estimate is seen
+    n : int
+        The number of permutations run
+    interval : (float, float)
+        The confidence interval on the p-value
+
+    Notes
+    -----
+    The permutations are those of `_permute()`, in the same order,
+    so running to `permutations` gives the same p-value
+    """
+    assert comparison in ('predictions', 'means')
+    if comparison == 'means':
+        X = np.append(a, b).astype(float)[:, np.newaxis]
+        extreme, n = _permute_columns(a.shape[0], X, permutations, chunk_size,
+                                      alpha, confidence, step)
+        lower, upper = _confidence_interval(extreme[0], n[0], confidence)
+        return float(extreme[0] / n[0]), int(n[0]), (float(lower),
+                                                     float(upper))
+    np.random.seed(42)
+    c, baseline, compare = _setup(a, b)
+    chunk_size = min(chunk_size or MAX_CHUNK_ELEMENTS, step * c.shape[0])
+    extreme = n = 0
+    for idx in _permutation_indices(c.shape[0], permutations, chunk_size):
+        v = compare(a, c[idx])
+        extreme += (np.abs(v) >= np.abs(baseline)).sum()
+        n += idx.shape[0]
+        lower, upper = _confidence_interval(extreme, n, confidence)
+        if _decided(lower, upper, alpha):
+            break
+    return float(extreme / n), n, (float(lower), float(upper))
+
+def _chunk_extreme(m, X, baseline, i, rows, columns):
+    """Number of permutations in chunk `i` at least as extreme as
+    `baseline`, for the given columns of `X`"""
+    k = min(m, X.shape[0] - m)
+    idx = _subset_chunk(X.shape[0], k, rows, i)
+    v = _diff_means_subsets(m, X[:, columns], idx)
+    return (np.abs(v) >= baseline[columns]).sum(axis=0)
+
+def _init_worker(m, X, baseline):
+    global _features
+    _features = (m, X, baseline)
+
+def _pooled_chunk(args):
+    m, X, baseline = _features
+    i, rows, columns = args
+    return _chunk_extreme(m, X, baseline, i, rows, columns)
+
+def _permute_columns(m, X, permutations=10000, chunk_size=None, alpha=None,
+                     confidence=0.999, step=SEQUENTIAL_STEP, n_jobs=1):
+    """The permutation engine of `_permute(comparison='means')`,
+    for every column of `X` at once with the same permutations
+
+    Parameters
+    ----------
+    m : int
+        Number of samples in the first class
+    X : np.ndarray
+        Data for both classes, shape (n_samples, n_columns)
+    permutations : int, optional
+        (Maximum) number of permutations
+    chunk_size : int, default None
+        Maximum number of elements held in memory per chunk
+    alpha : float, default None
+        If given, each column stops once the confidence interval on
+        its p-value is entirely above or below `alpha`
+        (see `_permute_sequential()`)
+    confidence : float, default 0.999
+        Coverage of the interval used to decide when to stop
+    step : int, default `SEQUENTIAL_STEP`
+        Permutations run between checks
+    n_jobs : int, default 1
+        Number of worker processes the chunks of permutations are
+        split across
+
+    Returns
+    -------
+    extreme, n : (np.ndarray, np.ndarray)
+        Permutations at least as extreme as observed, and permutations
+        run, for each column; `extreme / n` are two-tailed p-values
+
+    Notes
+    -----
+    Chunks are seeded by their number and their results are used in
+    order, stopping at the same chunk as a single process would, so
+    the output doesn't depend on `n_jobs`
+    """
+    assert 0 < m < X.shape[0]
+    rows = _chunk_rows(X.shape[0], chunk_size)
+    if alpha is not None:
+        rows = min(rows, step)
+    chunks = [(i, min(rows, permutations - start))
+              for i, start in enumerate(range(0, permutations, rows))]
+    sums = X[:m].sum(axis=0)
+    total = X.sum(axis=0)
+    baseline = np.abs(sums / m - (total - sums) / (X.shape[0] - m))
+    extreme = np.zeros(X.shape[1], dtype=np.int64)
+    n = np.zeros(X.shape[1], dtype=np.int64)
+    active = np.arange(X.shape[1])
+    n_jobs = max(1, min(n_jobs, len(chunks)))
+    pool = None
+    if n_jobs > 1:
+        pool = Pool(n_jobs, initializer=_init_worker,
+                    initargs=(m, X, baseline))
+    try:
+        for start in range(0, len(chunks), n_jobs):
+            batch = chunks[start:start + n_jobs]
+            submitted = active
+            if pool is None:
+                results = [_chunk_extreme(m, X, baseline, i, size, submitted)
+                           for i, size in batch]
+            else:
+                results = pool.map(_pooled_chunk,
+                                   [(i, size, submitted) for i, size in batch])
+            for (i, size), counts in zip(batch, results):
+                # columns that stopped earlier in this batch are ignored
+                is_active = np.zeros(X.shape[1], dtype=bool)
+                is_active[active] = True
+                keep = is_active[submitted]
+                extreme[submitted[keep]] += counts[keep]
+                n[submitted[keep]] += size
+                if alpha is not None:
+                    lower, upper = _confidence_interval(
+                        extreme[active], n[active], confidence)
+                    active = active[~_decided(lower, upper, alpha)]
+            if active.shape[0] == 0:
+                break
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return extreme, n
+
+def pvalue_table(a, b, columns=None, permutations=10000, chunk_size=None,
+                 n_jobs=1, alpha=None, confidence=0.999):
+    """Means and p-values, both permutation-based and classical,
+    for many features at once
+
+    Parameters
+    ----------
+    a : np.ndarray
+        Data for one class, shape (n_a, n_columns)
+    b : np.ndarray
+        Data for another class, shape (n_b, n_columns)
+    columns : list, default None
+        Feature names, of length n_columns
+    permutations : int, optional
+        (Maximum) number of permutations
+    chunk_size : int, default None
+        Maximum number of elements held in memory per chunk
+    n_jobs : int, default 1
+        Number of worker processes the chunks of permutations are
+        split across; -1 uses all cores
+    alpha : float, default None
+        If given, permutations stop early for each feature whose
+        p-value is clearly above or below `alpha`
+    confidence : float, default 0.999
+        Coverage of the interval used to decide when to stop
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per feature, with `mean_a`, `mean_b`, `permutation`
+        and `classical` (Welch's t-test) columns; with `alpha`, also
+        the number of `permutations` run and the `ci_lower` and
+        `ci_upper` bounds on the permutation p-value
+
+    Notes
+    -----
+    Without `alpha`, the permutation p-values equal
+    `_permute(comparison='means')` column by column; with or without
+    it, they don't depend on `n_jobs`
+    """
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    assert a.ndim == 2 and b.ndim == 2 and a.shape[1] == b.shape[1]
+    if columns is None:
+        columns = list(range(a.shape[1]))
+    assert len(columns) == a.shape[1]
+    if n_jobs < 0:
+        n_jobs = cpu_count()
+    extreme, n = _permute_columns(a.shape[0], np.vstack((a, b)),
+                                  permutations, chunk_size, alpha,
+                                  confidence, n_jobs=n_jobs)
+    classical = ttest_ind(a, b, axis=0, equal_var=False)[1]
+    table = pd.DataFrame({'mean_a' : a.mean(axis=0),
+                          'mean_b' : b.mean(axis=0),
+                          'permutation' : extreme / n,
+                          'classical' : classical},
+                         index=columns,
+                         columns=['mean_a', 'mean_b', 'permutation',
+                                  'classical'])
+    if alpha is not None:
+        table['permutations'] = n
+        table['ci_lower'], table['ci_upper'] = _confidence_interval(
+            extreme, n, confidence)
+    return table
+
 def print_pvalues(a, b):
     """Wrapper function for printing meand and p-values
     both permutation-based and classical
@@ -2,7 +2,7 @@ import numpy as np
 import pandas as pd
 from scipy.sparse.csr import csr_matrix
 
-from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.preprocessing import normalize
 
 from utils.lexical_features import pos_normalize
 from utils.text_representation import _levels
@@ -25,7 +25,7 @@ def _levels_dict(demographics):
     levels_dict = {k : v for k, v in enumerate(levels)}
     return levels_dict
 
-def most_like(demographics, doc, demo):
+def most_like(demographics, doc, demo, block_size=10000):
     """The demographic levels each user is most like
 
     Parameters
@@ -36,18 +36,37 @@ def most_like(demographics, doc, demo):
         Document-level tfidf matrix
     demo : scipy.sparse.csr.csr_matrix
         Demographic-level tfidf matrix
+    block_size : int, default 10000
+        Number of users to score at a time
 
     Returns
     -------
     ct : pd.DataFrame
         Normalized (row-wise) demographic level counts
+
+    Notes
+    -----
+    Cosine similarities are computed for `block_size` users at a
+    time and only the index of the most similar level is kept, so
+    memory doesn't grow with the number of users
     """
     assert isinstance(demographics, pd.Series)
     assert isinstance(doc, csr_matrix) and isinstance(demo, csr_matrix)
+    assert demographics.shape[0] == doc.shape[0]
     d_labels = _levels_dict(demographics)
-    scores = cosine_similarity(doc, demo)
-    df = pd.DataFrame(np.argmax(scores, axis=1), columns=['which'])
-    df['most_like'] = df.which.apply(lambda x : d_labels[x])
-    df['actual'] = demographics.values
-    ct = pd.crosstab(df.actual, df.most_like)
+    K = len(d_labels)
+    actual = pd.Index(list(d_labels.values())).get_indexer(demographics.values)
+    demo = normalize(demo).T.tocsc()
+    counts = np.zeros(K * K, dtype=np.int64)
+    for start in range(0, doc.shape[0], block_size):
+        block = normalize(doc[start:start + block_size])
+        scores = block.dot(demo).toarray()
+        which = np.argmax(scores, axis=1)
+        counts += np.bincount(actual[start:start + block_size] * K + which,
+                              minlength=K * K)
+    levels = [d_labels[k] for k in range(K)]
+    ct = pd.DataFrame(counts.reshape(K, K),
+                      index=pd.Index(levels, name='actual'),
+                      columns=pd.Index(levels, name='most_like'))
+    ct = ct.loc[:, ct.sum(axis=0) > 0]
     return pos_normalize(ct)
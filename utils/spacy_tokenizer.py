@@ -1,3 +1,4 @@
+from multiprocessing import Pool, cpu_count
 import string
 
 from spacy.en import English
@@ -5,6 +6,20 @@ from spacy.en import English
 
 nlp = English(tagger=False, parser=False, entity=False)
 
+def _remove_punctuation(tokens):
+    """Drop punctuation from spaCy tokens
+
+    Parameters
+    ----------
+    tokens : iterable
+        spaCy tokens (e.g., a `Doc`)
+
+    Returns
+    -------
+    list of tokens (as strings)
+    """
+    return [str(t) for t in tokens if str(t) not in string.punctuation]
+
 def spacy_tokenize(text):
     """Use spaCy's default tokenizer, which can
     handle "emoticons and other web-based features,"
@@ -26,4 +41,83 @@ def spacy_tokenize(text):
     """
     assert isinstance(text, str)
     tokens = nlp(text)
-    return [str(t) for t in tokens if str(t) not in string.punctuation]
+    return _remove_punctuation(tokens)
+
+def _batches(corpus, batch_size):
+    """Split a stream of documents into lists of `batch_size`
+
+    Parameters
+    ----------
+    corpus : iterable
+        A collection of documents
+    batch_size : int
+        Number of documents per batch
+
+    Yields
+    ------
+    list
+    """
+    batch = []
+    for doc in corpus:
+        batch.append(doc)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _tokenize_batch(texts):
+    """Tokenize a batch of documents with `nlp.pipe()`
+
+    Parameters
+    ----------
+    texts : list
+        Documents (as strings)
+
+    Returns
+    -------
+    list of lists of tokens (as strings)
+    """
+    return [_remove_punctuation(doc) for doc in nlp.pipe(texts)]
+
+def tokenize_corpus(corpus, lowercase=True, batch_size=1000, n_jobs=1):
+    """Tokenize a collection of documents with `spacy_tokenize()`
+    rules, streaming batches of documents through a process pool
+
+    Parameters
+    ----------
+    corpus : iterable
+        A collection of documents
+    lowercase : bool, default True
+        Whether to lowercase documents before tokenizing, as
+        `CountVectorizer` does by default
+    batch_size : int, default 1000
+        Number of documents sent to a worker at a time
+    n_jobs : int, default 1
+        Number of worker processes; -1 uses all cores
+
+    Returns
+    -------
+    tokenized : list
+        One list of tokens (as strings) per document
+
+    Notes
+    -----
+    The output can be passed to `feature_vectors()` (and
+    `_multinomial()`) with `pretokenized=True`
+    """
+    assert batch_size > 0
+    if lowercase:
+        corpus = (doc.lower() for doc in corpus)
+    batches = _batches(corpus, batch_size)
+    if n_jobs == -1:
+        n_jobs = cpu_count()
+    tokenized = []
+    if n_jobs == 1:
+        for batch in batches:
+            tokenized.extend(_tokenize_batch(batch))
+    else:
+        with Pool(n_jobs) as pool:
+            for tokens in pool.imap(_tokenize_batch, batches):
+                tokenized.extend(tokens)
+    return tokenized
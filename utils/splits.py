@@ -1,6 +1,65 @@
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import TfidfTransformer
 
+from utils.distinctive_tokens import log_odds_ratio, top_bottom
+
+
+def group_sums(X, codes, n_groups):
+    """Column totals of `X` for each group of rows, computed
+    with a single sparse matrix product
+
+    Parameters
+    ----------
+    X : scipy.sparse.csr.csr_matrix or np.ndarray
+        shape (n_samples, n_features)
+    codes : np.ndarray
+        The group (0 to `n_groups` - 1) of each row in `X`;
+        rows with a negative code are left out
+    n_groups : int
+        Number of groups
+
+    Returns
+    -------
+    sums : np.ndarray
+        shape (n_groups, n_features)
+
+    Notes
+    -----
+    The sparse group-indicator matrix has one nonzero per row
+    in `X`, so this is O(nnz) no matter the number of groups
+    """
+    codes = np.asarray(codes)
+    assert codes.shape[0] == X.shape[0]
+    rows = np.flatnonzero(codes >= 0)
+    indicator = sp.csr_matrix((np.ones(rows.shape[0], dtype=X.dtype),
+                               (codes[rows], rows)),
+                              shape=(n_groups, X.shape[0]))
+    sums = indicator.dot(X)
+    if sp.issparse(sums):
+        sums = sums.toarray()
+    return np.asarray(sums)
+
+def level_sums(X, labels, levels):
+    """Column totals of `X` for each demographic level
+
+    Parameters
+    ----------
+    X : scipy.sparse.csr.csr_matrix or np.ndarray
+        shape (n_samples, n_features)
+    labels : array-like
+        The demographic level of each row in `X`
+    levels : list
+        Levels to total; rows with other labels are left out
+
+    Returns
+    -------
+    sums : np.ndarray
+        shape (len(levels), n_features), in the order of `levels`
+    """
+    codes = pd.Index(levels).get_indexer(np.asarray(labels))
+    return group_sums(X, codes, len(levels))
 
 def counts_by_class(cm, df, col, one_vs_one=True, vals=None):
     """Aggregates token frequencies for a particular binary
@@ -29,13 +88,11 @@ def counts_by_class(cm, df, col, one_vs_one=True, vals=None):
     """
     if one_vs_one:
         assert isinstance(vals, list) and len(vals) == 2
-        c0 = cm[np.array(df[col]==vals[0]), :].sum(axis=0)
-        c1 = cm[np.array(df[col]==vals[1]), :].sum(axis=0)
+        counts = level_sums(cm, df[col].values, vals)
     else:
         assert isinstance(vals, (int, str))
-        c0 = cm[np.array(df[col]==vals), :].sum(axis=0)
-        c1 = cm[np.array(df[col]!=vals), :].sum(axis=0)
-    counts = np.array(np.vstack((c0, c1)))
+        codes = np.array(df[col] != vals, dtype=int)
+        counts = group_sums(cm, codes, 2)
     return counts
 
 def diff_prop(counts, vocabulary):
@@ -76,13 +133,12 @@ def wf(df, n):
     wf_top, wf_bottom : list, list
         (token, value) tuples
     """
-    df = df.copy()
     col = df.columns[0]
-    tmp = df.sort(col, ascending=False)
-    top = tmp.iloc[:n]
-    bottom = tmp.iloc[-n:]
-    wf_top = list(zip(top.index, top[col]))
-    wf_bottom = list(zip(bottom.index, bottom[col] * -1))
+    values = df[col].values
+    top, bottom, top_idx, bottom_idx = top_bottom(values, df.index, n)
+    wf_top = list(zip(top, values[top_idx]))
+    # largest to smallest, as in the tail of a descending sort
+    wf_bottom = list(zip(bottom[::-1], values[bottom_idx[::-1]] * -1))
     return wf_top, wf_bottom
 
 def subset_df(df, col, vals):
@@ -123,9 +179,251 @@ def group_pct(df, demographic):
         Including `demographic` levels and `group` percentages
     """
     df = df.copy()
+    # only observed levels (not every category) should be grouped on
+    df[demographic] = df[demographic].astype(object)
     by_dg = pd.DataFrame({'count' :
                           df.groupby([demographic, 'group'])['group'].count()}).reset_index()
     by_d = by_dg.groupby(demographic, as_index=False)['count'].sum()
     by_dg = pd.merge(by_dg, by_d, on=demographic)
     by_dg['pct'] = by_dg.count_x / by_dg.count_y
     return by_dg
+
+
+class DemographicCounts(object):
+    """Running per-level aggregates for one demographic column, updated
+    as batches of users are added or removed, so that `diff_prop()`,
+    `log_odds_ratio()`, demographic tf-idf and `group_pct()` can be
+    served without revisiting the full count matrix
+
+    Parameters
+    ----------
+    demographic : str
+        The demographic column name (used in `group_pct()`)
+    vocabulary : list
+        The vocabulary of the count matrices that will be added
+    n_groups : int, default 0
+        Number of NMF groups tracked per level
+
+    Attributes
+    ----------
+    levels : list
+        Demographic levels, in the order they were first seen
+    token_counts : np.ndarray
+        shape (len(levels), n_features), token totals per level
+    user_counts : np.ndarray
+        Number of users per level
+    group_counts : np.ndarray
+        shape (len(levels), n_groups), users per (level, group)
+    tfidf_sums : np.ndarray
+        shape (len(levels), n_features), tf-idf vector totals per level
+    missing_counts : np.ndarray
+        Token totals of users whose level is missing, which are only
+        counted in the "rest" of one-vs-rest splits
+    missing_users : int
+        Number of users whose level is missing
+    """
+
+    def __init__(self, demographic, vocabulary, n_groups=0):
+        self.demographic = demographic
+        self.vocabulary = list(vocabulary)
+        self.n_groups = n_groups
+        self.levels = []
+        n_features = len(self.vocabulary)
+        self.token_counts = np.zeros((0, n_features), dtype=np.int64)
+        self.user_counts = np.zeros(0, dtype=np.int64)
+        self.group_counts = np.zeros((0, n_groups), dtype=np.int64)
+        self.tfidf_sums = np.zeros((0, n_features))
+        self.missing_counts = np.zeros(n_features, dtype=np.int64)
+        self.missing_users = 0
+
+    def _codes(self, labels):
+        """Level index of each label, with unseen levels numbered after
+        the known ones (but not added); missing labels get -1
+
+        Returns
+        -------
+        codes, new : (np.ndarray, list)
+        """
+        labels = np.asarray(labels, dtype=object)
+        observed = pd.notnull(labels)
+        new = [l for l in pd.unique(labels[observed]) if l not in self.levels]
+        codes = pd.Index(self.levels + new).get_indexer(labels)
+        codes[~observed] = -1
+        return codes, new
+
+    def _grow(self, new):
+        """Add zeroed rows for the levels in `new`"""
+        n = len(new)
+        self.levels.extend(new)
+        self.token_counts = np.vstack((self.token_counts,
+            np.zeros((n, self.token_counts.shape[1]),
+                     dtype=self.token_counts.dtype)))
+        self.user_counts = np.append(self.user_counts,
+                                     np.zeros(n, dtype=np.int64))
+        self.group_counts = np.vstack((self.group_counts,
+            np.zeros((n, self.n_groups), dtype=np.int64)))
+        self.tfidf_sums = np.vstack((self.tfidf_sums,
+            np.zeros((n, self.tfidf_sums.shape[1]))))
+
+    def _update(self, sign, X, labels, groups=None, tfidf=None):
+        """Validate a batch, then apply it; the state is left unchanged
+        if any check fails"""
+        assert X.shape[1] == len(self.vocabulary)
+        codes, new = self._codes(labels)
+        assert codes.shape[0] == X.shape[0]
+        if sign < 0:
+            assert not new, 'Unknown level(s): %s' % new
+        n_levels = len(self.levels) + len(new)
+        observed = codes >= 0
+        tokens = group_sums(X, codes, n_levels)
+        users = np.bincount(codes[observed], minlength=n_levels)
+        missing = np.asarray(X[np.flatnonzero(~observed)].sum(axis=0)).ravel()
+        cells = np.zeros((n_levels, self.n_groups), dtype=np.int64)
+        if groups is not None:
+            groups = np.asarray(groups)
+            assert groups.shape[0] == X.shape[0]
+            assert ((groups >= 0) & (groups < self.n_groups)).all()
+            cells = np.bincount(
+                codes[observed] * self.n_groups + groups[observed],
+                minlength=n_levels * self.n_groups).reshape(n_levels,
+                                                            self.n_groups)
+        if tfidf is not None:
+            assert tfidf.shape == X.shape
+            tfidf = group_sums(tfidf, codes, n_levels)
+        if sign < 0:
+            assert (self.user_counts >= users).all(), \
+                'Removed users never added'
+            assert (self.group_counts >= cells).all(), \
+                'Removed users never added'
+            assert (self.token_counts >= tokens).all(), \
+                'Removed tokens never added'
+            assert (self.missing_counts >= missing).all(), \
+                'Removed tokens never added'
+        if new:
+            self._grow(new)
+        self.token_counts = self.token_counts + sign * tokens
+        self.user_counts += sign * users
+        self.group_counts += sign * cells
+        self.missing_counts = self.missing_counts + sign * missing
+        self.missing_users += sign * int((~observed).sum())
+        if tfidf is not None:
+            self.tfidf_sums += sign * tfidf
+
+    def add(self, X, labels, groups=None, tfidf=None):
+        """Add a batch of users
+
+        Parameters
+        ----------
+        X : scipy.sparse.csr.csr_matrix
+            Token counts, shape (n_samples, n_features)
+        labels : array-like
+            The demographic level of each user; users with a missing
+            level only count towards `missing_counts`
+        groups : array-like, default None
+            The NMF group of each user (e.g., from `nmf_labels()`)
+        tfidf : scipy.sparse.csr.csr_matrix, default None
+            The users' tf-idf vectors, for `centroids()`
+
+        Returns
+        -------
+        self
+        """
+        self._update(1, X, labels, groups, tfidf)
+        return self
+
+    def remove(self, X, labels, groups=None, tfidf=None):
+        """Remove a batch of previously added users; the batch is
+        rejected (and nothing changed) if it has unknown levels or
+        would leave any count negative
+
+        Parameters
+        ----------
+        See `add()`
+
+        Returns
+        -------
+        self
+        """
+        self._update(-1, X, labels, groups, tfidf)
+        return self
+
+    def counts(self, vals, one_vs_one=True):
+        """Token totals for a split, as from `counts_by_class()`
+
+        Parameters
+        ----------
+        vals : list, int, str
+            Two levels when `one_vs_one`, otherwise a single level
+            (compared against all other users, including those whose
+            level is missing, as in `counts_by_class()`)
+        one_vs_one : bool, default True
+            whether the split is based on two distinct values
+
+        Returns
+        -------
+        counts : np.ndarray
+            shape (2, n_features)
+        """
+        index = pd.Index(self.levels)
+        if one_vs_one:
+            assert isinstance(vals, list) and len(vals) == 2
+            rows = index.get_indexer(vals)
+            assert (rows >= 0).all(), 'Unknown level'
+            return self.token_counts[rows]
+        assert isinstance(vals, (int, str))
+        row = index.get_loc(vals)
+        rest = (self.token_counts.sum(axis=0) - self.token_counts[row] +
+                self.missing_counts)
+        return np.vstack((self.token_counts[row], rest))
+
+    def diff_prop(self, vals, one_vs_one=True):
+        """`diff_prop()` for a split; see `counts()`"""
+        return diff_prop(self.counts(vals, one_vs_one), self.vocabulary)
+
+    def log_odds_ratio(self, vals, one_vs_one=True, **kwargs):
+        """`log_odds_ratio()` for a split; see `counts()`"""
+        return log_odds_ratio(self.counts(vals, one_vs_one),
+                              self.vocabulary, **kwargs)
+
+    def tfidf(self):
+        """The demographic-level tf-idf matrix, as the second
+        output of `tfidf_matrices()` (rows in the order of `levels`)
+
+        Returns
+        -------
+        scipy.sparse.csr.csr_matrix
+        """
+        return TfidfTransformer().fit_transform(self.token_counts)
+
+    def centroids(self):
+        """Mean tf-idf vector of the users in each level
+
+        Returns
+        -------
+        pd.DataFrame
+            Levels as indices and the vocabulary as columns
+        """
+        users = np.maximum(self.user_counts, 1)[:, np.newaxis]
+        return pd.DataFrame(self.tfidf_sums / users, index=self.levels,
+                            columns=self.vocabulary)
+
+    def group_pct(self):
+        """`group_pct()` from the running (level, group) counts
+
+        Returns
+        -------
+        by_dg : pd.DataFrame
+            Including `demographic` levels and `group` percentages
+        """
+        rows, groups = np.nonzero(self.group_counts)
+        by_dg = pd.DataFrame({self.demographic :
+                                  np.array(self.levels, dtype=object)[rows],
+                              'group' : groups,
+                              'count_x' : self.group_counts[rows, groups],
+                              'count_y' : self.group_counts.sum(axis=1)[rows]},
+                             columns=[self.demographic, 'group',
+                                      'count_x', 'count_y'])
+        by_dg = by_dg.sort_values([self.demographic, 'group'])
+        by_dg = by_dg.reset_index(drop=True)
+        by_dg['pct'] = by_dg.count_x / by_dg.count_y
+        return by_dg
@@ -1,9 +1,16 @@
+import json
+
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 from sklearn.feature_extraction.text import CountVectorizer
 from sklearn.feature_extraction.text import TfidfTransformer
+from sklearn.preprocessing import normalize
+from sklearn.utils import murmurhash3_32
 
-from utils.spacy_tokenizer import spacy_tokenize
+from utils.spacy_tokenizer import _batches, spacy_tokenize
+from utils.splits import level_sums
+from utils.token_cache import TokenCache, cached_tokenize_corpus
 
 
 def _levels(demographics, d_levels=None, print_levels=False):
@@ -23,7 +30,7 @@ def _levels(demographics, d_levels=None, print_levels=False):
     levels : iterable
         The unique (sorted) levels in `demographics`
     """
-    levels = demographics.unique()
+    levels = np.asarray(demographics.unique())
     if d_levels:
         assert set(d_levels).issubset(levels)
         levels = d_levels
@@ -32,7 +39,34 @@ def _levels(demographics, d_levels=None, print_levels=False):
         print('Levels (in order):', levels, end='\n\n')
     return levels
 
-def _multinomial(corpus, kwargs):
+def _identity(x):
+    """Pass pre-tokenized documents through `CountVectorizer` as-is"""
+    return x
+
+def _vectorizer(kwargs, pretokenized=False):
+    """`CountVectorizer` using the spaCy tokenizer
+
+    Parameters
+    ----------
+    kwargs : dict or None
+        Keyword arguments of variable length
+    pretokenized : bool, default False
+        Whether documents are lists of tokens, as returned
+        by `tokenize_corpus()`, rather than strings
+
+    Returns
+    -------
+    sklearn.feature_extraction.text.CountVectorizer
+    """
+    kwargs = dict(kwargs) if kwargs else {}
+    if pretokenized:
+        # tokens are already lowercased by `tokenize_corpus()`
+        kwargs.pop('lowercase', None)
+        return CountVectorizer(tokenizer=_identity, preprocessor=_identity,
+                               lowercase=False, **kwargs)
+    return CountVectorizer(tokenizer=spacy_tokenize, **kwargs)
+
+def _multinomial(corpus, kwargs, pretokenized=False, cache_dir=None):
     """Tokens counts by document using the spaCy tokenizer
 
     Parameters
@@ -41,6 +75,11 @@ def _multinomial(corpus, kwargs):
         A collection of documents
     kwargs : dict or None
         Keyword arguments of variable length
+    pretokenized : bool, default False
+        Whether `corpus` is the output of `tokenize_corpus()`
+    cache_dir : str, default None
+        If given, tokens are read from (and added to) the
+        on-disk token cache in this directory
 
     Returns
     -------
@@ -49,14 +88,119 @@ def _multinomial(corpus, kwargs):
     v : list
         Vocabulary
     """
-    if kwargs:
-        cv = CountVectorizer(tokenizer=spacy_tokenize, **kwargs)
-    else:
-        cv = CountVectorizer(tokenizer=spacy_tokenize)
+    if cache_dir and not pretokenized:
+        lowercase = kwargs.get('lowercase', True) if kwargs else True
+        corpus = cached_tokenize_corpus(corpus, cache_dir, lowercase)
+        pretokenized = True
+    cv = _vectorizer(kwargs, pretokenized)
     X = cv.fit_transform(corpus)
     v = cv.get_feature_names()
     return X, v
 
+def _space_saving(counts, ngram, n_names):
+    """Update the approximate top `n_names` n-grams of a hashed column
+
+    Parameters
+    ----------
+    counts : dict
+        n-gram counts for the column (at most `n_names` entries)
+    ngram : str
+        An n-gram hashed to the column
+    n_names : int
+        Number of n-grams to track per column
+
+    Returns
+    -------
+    None
+
+    Notes
+    -----
+    This is the Space-Saving algorithm (Metwally et al., 2005): when
+    the column is full, the least frequent n-gram is replaced and the
+    new n-gram inherits its count
+    """
+    if ngram in counts:
+        counts[ngram] += 1
+    elif len(counts) < n_names:
+        counts[ngram] = 1
+    else:
+        least = min(counts, key=counts.get)
+        counts[ngram] = counts.pop(least) + 1
+
+def _hashed_names(names, n_features):
+    """Readable names for hashed columns
+
+    Parameters
+    ----------
+    names : dict
+        n-gram counts, by column (from `_space_saving()`)
+    n_features : int
+        Number of columns
+
+    Returns
+    -------
+    list
+        The column's n-grams, most frequent first, joined by ' | '
+        (an empty string for columns no n-gram was hashed to)
+    """
+    return [' | '.join(sorted(names[i], key=names[i].get, reverse=True))
+            if i in names else '' for i in range(n_features)]
+
+def _hashing(corpus, kwargs, n_features, pretokenized=False, cache_dir=None,
+             batch_size=1000, n_names=3):
+    """Token counts by document, hashed into a fixed number of columns
+
+    Parameters
+    ----------
+    corpus : iterable
+        A collection of documents
+    kwargs : dict or None
+        Keyword arguments of variable length; `min_df`, `max_df`,
+        `max_features` and `vocabulary` don't apply and are ignored
+    n_features : int
+        Number of columns
+    pretokenized : bool, default False
+        Whether `corpus` is the output of `tokenize_corpus()`
+    cache_dir : str, default None
+        Directory of the on-disk token cache (see `token_cache.py`)
+    batch_size : int, default 1000
+        Number of documents to vectorize at a time
+    n_names : int, default 3
+        Number of n-grams to remember for each column
+
+    Returns
+    -------
+    X : scipy.sparse.csr.csr_matrix
+        The multinomial representation shape (n_samples, n_features)
+    v : list
+        The top n-grams of each column (see `_hashed_names()`)
+    """
+    lowercase = kwargs.get('lowercase', True) if kwargs else True
+    analyze = _vectorizer(kwargs, pretokenized or bool(cache_dir)).build_analyzer()
+    names = {}
+    batches = []
+    # one cache for all batches, with the index written once at the end
+    cache = None
+    if cache_dir and not pretokenized:
+        cache = TokenCache(cache_dir, lowercase)
+    for batch in _batches(corpus, batch_size):
+        if cache is not None:
+            batch = cache.tokenize(batch, flush=False)
+        rows, cols = [], []
+        for i, doc in enumerate(batch):
+            for ngram in analyze(doc):
+                col = murmurhash3_32(ngram, positive=True) % n_features
+                _space_saving(names.setdefault(col, {}), ngram, n_names)
+                rows.append(i)
+                cols.append(col)
+        X = sp.coo_matrix((np.ones(len(cols), dtype=np.int64), (rows, cols)),
+                          shape=(len(batch), n_features))
+        batches.append(X.tocsr())
+    if cache is not None:
+        cache.flush()
+    X = sp.vstack(batches, format='csr')
+    return X, _hashed_names(names, n_features)
+
 def _tfidf(X):
     """tf-idf representation of a count matrix
 
@@ -74,7 +218,8 @@ def _tfidf(X):
     X_ = tt.fit_transform(X)
     return X_
 
-def feature_vectors(corpus, kwargs=None):
+def feature_vectors(corpus, kwargs=None, pretokenized=False, cache_dir=None,
+                    n_features=None, batch_size=1000):
     """Multinomial and TF-IDF representations
 
     Paramaters
@@ -85,6 +230,17 @@ def feature_vectors(corpus, kwargs=None):
         Keyword arguments of variable length
         See sklearn.feature_extraction.text.CountVectorizer
         for accepted keyword arguments
+    pretokenized : bool, default False
+        Whether `corpus` is the output of `tokenize_corpus()`,
+        which skips tokenizing documents one at a time
+    cache_dir : str, default None
+        Directory of the on-disk token cache (see `token_cache.py`)
+    n_features : int, default None
+        If given, n-grams are hashed into `n_features` columns,
+        `batch_size` documents at a time, instead of building
+        a vocabulary (so `min_df` and `max_df` don't apply)
+    batch_size : int, default 1000
+        Number of documents to vectorize at a time when hashing
 
     Returns
     -------
@@ -93,14 +249,18 @@ def feature_vectors(corpus, kwargs=None):
     tfidf : scipy.sparse.csr.csr_matrix
         The tf-idf representation
     vocab : list
-        Vocabulary
+        Vocabulary or, when hashing, the top n-grams in each column
     """
     assert isinstance(corpus, (list, pd.Series))
-    count, vocab = _multinomial(corpus, kwargs)
+    if n_features:
+        count, vocab = _hashing(corpus, kwargs, n_features, pretokenized,
+                                cache_dir, batch_size)
+    else:
+        count, vocab = _multinomial(corpus, kwargs, pretokenized, cache_dir)
     tfidf = _tfidf(count)
     return count, tfidf, vocab
 
-def tfidf_matrices(corpus, demographics, vocabulary=None):
+def tfidf_matrices(corpus, demographics, vocabulary=None, cache_dir=None):
     """For creating tfidf matrices of:
         * documents
         * demographic levels
@@ -113,6 +273,8 @@ def tfidf_matrices(corpus, demographics, vocabulary=None):
         Demographic labels
     vocabulary : list, default None
         Tokens to consider
+    cache_dir : str, default None
+        Directory of the on-disk token cache (see `token_cache.py`)
 
     Returns
     -------
@@ -130,11 +292,185 @@ def tfidf_matrices(corpus, demographics, vocabulary=None):
     assert (isinstance(corpus, pd.Series) and
             isinstance(demographics, pd.Series))
     assert corpus.shape[0] == demographics.shape[0]
-    doc_level, _ = _multinomial(corpus, vocabulary=vocabulary)
+    doc_level, _ = _multinomial(corpus, {'vocabulary' : vocabulary},
+                                cache_dir=cache_dir)
     levels = _levels(demographics)
-    splits = []
-    for level in levels:
-        mask = demographics.values == level
-        splits.append(np.asarray(doc_level[mask].sum(axis=0))[0])
-    demo_level = np.stack(splits)
+    demo_level = level_sums(doc_level, demographics.values, levels)
     return _tfidf(doc_level), _tfidf(demo_level)
+
+
+class FeatureVectorizer(object):
+    """`feature_vectors()` fit once, on a full corpus, and reused to
+    transform subsets or new batches of documents with the same
+    vocabulary and IDF weights
+
+    Parameters
+    ----------
+    kwargs : dict, default None
+        Keyword arguments of variable length
+        See sklearn.feature_extraction.text.CountVectorizer
+        for accepted keyword arguments
+    cache_dir : str, default None
+        Directory of the on-disk token cache (see `token_cache.py`),
+        so that documents seen when fitting aren't re-tokenized
+
+    Attributes
+    ----------
+    vocabulary : list
+        Vocabulary, set by `fit()`
+    idf : np.ndarray
+        IDF weights, set by `fit()`
+    """
+
+    def __init__(self, kwargs=None, cache_dir=None):
+        self.kwargs = dict(kwargs) if kwargs else {}
+        self.cache_dir = cache_dir
+        self.vocabulary = None
+        self.idf = None
+
+    def fit_transform(self, corpus, pretokenized=False):
+        """Fit the vocabulary and IDF weights on `corpus`
+
+        Parameters
+        ----------
+        corpus : array-like
+            A collection of documents
+        pretokenized : bool, default False
+            Whether `corpus` is the output of `tokenize_corpus()`
+
+        Returns
+        -------
+        count, tfidf, vocab
+            As returned by `feature_vectors()`
+        """
+        count, vocab = _multinomial(corpus, self.kwargs, pretokenized,
+                                    self.cache_dir)
+        tt = TfidfTransformer()
+        tfidf = tt.fit_transform(count)
+        self.vocabulary = vocab
+        self.idf = tt.idf_
+        return count, tfidf, vocab
+
+    def fit(self, corpus, pretokenized=False):
+        self.fit_transform(corpus, pretokenized)
+        return self
+
+    def transform_batches(self, corpus, pretokenized=False, batch_size=None):
+        """Yield count and tf-idf representations, using the fitted
+        vocabulary and IDF weights, `batch_size` documents at a time
+
+        Parameters
+        ----------
+        corpus : array-like
+            A collection of documents
+        pretokenized : bool, default False
+            Whether `corpus` is the output of `tokenize_corpus()`
+        batch_size : int, default None
+            Number of documents per batch; all at once if None
+
+        Yields
+        ------
+        count, tfidf : (scipy.sparse.csr.csr_matrix,
+                        scipy.sparse.csr.csr_matrix)
+            For each batch, as returned by `transform()`
+        """
+        assert self.vocabulary is not None, 'Must call fit() first'
+        kwargs = dict(self.kwargs, vocabulary=self.vocabulary)
+        corpus = list(corpus)
+        assert corpus, 'Must have at least one document'
+        if not batch_size:
+            batch_size = len(corpus)
+        # one cache for all batches, with the index written once at the end
+        cache = None
+        if self.cache_dir and not pretokenized:
+            cache = TokenCache(self.cache_dir, kwargs.get('lowercase', True))
+        idf = sp.diags(self.idf, 0)
+        try:
+            for i in range(0, len(corpus), batch_size):
+                batch = corpus[i:i + batch_size]
+                if cache is not None:
+                    batch = cache.tokenize(batch, flush=False)
+                count, _ = _multinomial(batch, kwargs,
+                                        pretokenized or cache is not None)
+                yield count, normalize(count.dot(idf), norm='l2')
+        finally:
+            if cache is not None:
+                cache.flush()
+
+    def transform(self, corpus, pretokenized=False, batch_size=None):
+        """Count and tf-idf representations using the fitted
+        vocabulary and IDF weights
+
+        Parameters
+        ----------
+        corpus : array-like
+            A collection of documents
+        pretokenized : bool, default False
+            Whether `corpus` is the output of `tokenize_corpus()`
+        batch_size : int, default None
+            If given, documents are vectorized `batch_size` at a time
+            (see `transform_batches()`)
+
+        Returns
+        -------
+        count : scipy.sparse.csr.csr_matrix
+            The multinomial representation shape (n_samples, n_features)
+        tfidf : scipy.sparse.csr.csr_matrix
+            The tf-idf representation
+        """
+        batches = list(self.transform_batches(corpus, pretokenized,
+                                              batch_size))
+        count = sp.vstack([c for c, _ in batches], format='csr')
+        tfidf = sp.vstack([t for _, t in batches], format='csr')
+        return count, tfidf
+
+    def _arrays(self):
+        """The fitted state, as arrays for `np.savez()`"""
+        assert self.vocabulary is not None, 'Must call fit() first'
+        kwargs = {k : v for k, v in self.kwargs.items() if k != 'vocabulary'}
+        return {'vocabulary' : np.array(self.vocabulary, dtype=str),
+                'idf' : self.idf, 'kwargs' : np.array(json.dumps(kwargs))}
+
+    @classmethod
+    def _from_arrays(cls, data, cache_dir=None):
+        """A `FeatureVectorizer` from the output of `_arrays()`"""
+        kwargs = json.loads(str(data['kwargs']))
+        if 'ngram_range' in kwargs:
+            kwargs['ngram_range'] = tuple(kwargs['ngram_range'])
+        fv = cls(kwargs, cache_dir)
+        fv.vocabulary = data['vocabulary'].tolist()
+        fv.idf = data['idf']
+        return fv
+
+    def save(self, path):
+        """Save the vocabulary, IDF weights and keyword
+        arguments to an `.npz` file
+
+        Parameters
+        ----------
+        path : str
+            Relative or absolute filepath
+
+        Returns
+        -------
+        None
+        """
+        np.savez(path, **self._arrays())
+
+    @classmethod
+    def load(cls, path, cache_dir=None):
+        """Load a `FeatureVectorizer` saved with `save()`
+
+        Parameters
+        ----------
+        path : str
+            Relative or absolute filepath
+        cache_dir : str, default None
+            Directory of the on-disk token cache
+
+        Returns
+        -------
+        FeatureVectorizer
+        """
+        with np.load(path) as data:
+            return cls._from_arrays(data, cache_dir)
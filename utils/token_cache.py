@@ -0,0 +1,215 @@
+"""
+A persistent, on-disk cache of spaCy tokens so that repeated
+vectorizations of the same documents skip the tokenizer.
+
+Each tokenizer configuration gets its own directory (named by a hash of
+the configuration), which holds:
+    * strings.json : the shared string table (token id -> token)
+    * index.json   : document hash -> [offset, length] into tokens.bin
+    * tokens.bin   : token ids for every cached document (int32)
+"""
+import hashlib
+import json
+import os
+import string
+
+import numpy as np
+
+from utils.spacy_tokenizer import tokenize_corpus
+
+
+# bump when `spacy_tokenize()` rules change to invalidate existing caches
+TOKENIZER_VERSION = 1
+
+def _md5(text):
+    """md5 hex digest of a string"""
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+def _config_key(lowercase):
+    """Hash of the tokenizer settings, used to name the cache directory
+
+    Parameters
+    ----------
+    lowercase : bool
+        Whether documents are lowercased before tokenizing
+
+    Returns
+    -------
+    str
+    """
+    config = {'version' : TOKENIZER_VERSION,
+              'lowercase' : lowercase,
+              'punctuation' : string.punctuation}
+    return _md5(json.dumps(config, sort_keys=True))
+
+def _write_json(obj, path):
+    """Write `obj` to `path` without leaving a partial file behind"""
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp, path)
+
+def _read_json(path, default):
+    if not os.path.exists(path):
+        return default
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+class TokenCache(object):
+    """Token ids, by document hash, for a particular tokenizer configuration
+
+    Parameters
+    ----------
+    cache_dir : str
+        Relative or absolute path of the root cache directory
+    lowercase : bool, default True
+        Whether documents are lowercased before tokenizing
+    """
+
+    def __init__(self, cache_dir, lowercase=True):
+        assert isinstance(cache_dir, str)
+        self.lowercase = lowercase
+        self.path = os.path.join(cache_dir, _config_key(lowercase))
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self._strings_path = os.path.join(self.path, 'strings.json')
+        self._index_path = os.path.join(self.path, 'index.json')
+        self._tokens_path = os.path.join(self.path, 'tokens.bin')
+        self.strings = _read_json(self._strings_path, [])
+        self.string_ids = {s : i for i, s in enumerate(self.strings)}
+        self.index = _read_json(self._index_path, {})
+        self._table = None
+        self._dirty = False
+
+    def _token_ids(self):
+        """Memory-mapped token ids for all cached documents"""
+        if (not os.path.exists(self._tokens_path) or
+                os.path.getsize(self._tokens_path) == 0):
+            return np.empty(0, dtype=np.int32)
+        return np.memmap(self._tokens_path, dtype=np.int32, mode='r')
+
+    def __contains__(self, doc):
+        return _md5(doc) in self.index
+
+    def add(self, docs, tokenized, flush=True):
+        """Add tokenized documents to the cache
+
+        Parameters
+        ----------
+        docs : list
+            Documents (as strings)
+        tokenized : list
+            One list of tokens (as strings) per document in `docs`
+        flush : bool, default True
+            Whether to rewrite the string table and index now; when
+            adding many batches, pass False and call `flush()` once
+
+        Returns
+        -------
+        None
+        """
+        assert len(docs) == len(tokenized)
+        offset = int(self._token_ids().shape[0])
+        ids = []
+        for doc, tokens in zip(docs, tokenized):
+            key = _md5(doc)
+            if key in self.index:
+                continue
+            for t in tokens:
+                if t not in self.string_ids:
+                    self.string_ids[t] = len(self.strings)
+                    self.strings.append(t)
+                ids.append(self.string_ids[t])
+            self.index[key] = [offset, len(tokens)]
+            offset += len(tokens)
+        with open(self._tokens_path, 'ab') as f:
+            f.write(np.array(ids, dtype=np.int32).tobytes())
+        self._dirty = True
+        if flush:
+            self.flush()
+
+    def flush(self):
+        """Write the string table and index to disk, if changed"""
+        if self._dirty:
+            _write_json(self.strings, self._strings_path)
+            _write_json(self.index, self._index_path)
+            self._dirty = False
+
+    def get(self, docs):
+        """Cached tokens for documents
+
+        Parameters
+        ----------
+        docs : iterable
+            Documents (as strings), all of which must be cached
+
+        Returns
+        -------
+        list
+            One list of tokens (as strings) per document
+        """
+        token_ids = self._token_ids()
+        if self._table is None or self._table.shape[0] != len(self.strings):
+            self._table = np.array(self.strings, dtype=object)
+        tokenized = []
+        for doc in docs:
+            offset, length = self.index[_md5(doc)]
+            tokenized.append(
+                self._table[token_ids[offset:offset + length]].tolist())
+        return tokenized
+
+    def tokenize(self, corpus, batch_size=1000, n_jobs=1, flush=True):
+        """`tokenize_corpus()`, only running spaCy on documents
+        that are not already cached
+
+        Parameters
+        ----------
+        corpus : array-like
+            A collection of documents
+        batch_size : int, default 1000
+            Number of documents sent to a worker at a time
+        n_jobs : int, default 1
+            Number of worker processes; -1 uses all cores
+        flush : bool, default True
+            See `add()`
+
+        Returns
+        -------
+        list
+            One list of tokens (as strings) per document
+        """
+        corpus = list(corpus)
+        missing = list({doc for doc in corpus if doc not in self})
+        if missing:
+            tokenized = tokenize_corpus(missing, self.lowercase, batch_size,
+                                        n_jobs)
+            self.add(missing, tokenized, flush)
+        return self.get(corpus)
+
+
+def cached_tokenize_corpus(corpus, cache_dir, lowercase=True,
+                           batch_size=1000, n_jobs=1):
+    """`tokenize_corpus()`, only running spaCy on documents
+    that are not already in the on-disk cache
+
+    Parameters
+    ----------
+    corpus : array-like
+        A collection of documents
+    cache_dir : str
+        Relative or absolute path of the root cache directory
+    lowercase : bool, default True
+        Whether to lowercase documents before tokenizing
+    batch_size : int, default 1000
+        Number of documents sent to a worker at a time
+    n_jobs : int, default 1
+        Number of worker processes; -1 uses all cores
+
+    Returns
+    -------
+    list
+        One list of tokens (as strings) per document
+    """
+    cache = TokenCache(cache_dir, lowercase)
+    return cache.tokenize(corpus, batch_size, n_jobs)